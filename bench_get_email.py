@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+"""
+Benchmark get_email.py against a local stand-in IMAP server.
+
+The server keeps a reproducible synthetic mailbox in memory and speaks just
+enough IMAP4rev1 for get_email.py (LOGIN, LIST, SELECT/EXAMINE, SEARCH,
+FETCH, UID SEARCH/FETCH, CLOSE, LOGOUT). It counts commands (round trips)
+and bytes sent. That compares the old one-FETCH-per-message loop with the
+batched fetch and with the multi-connection fetch over every folder. It also
+compares a full sync with an incremental one after a day's worth of new and
+expunged mail. --latency adds a delay to every command, the way a distant
+server would. --drop-every makes the parallel run reconnect mid-job:
+
+   bench_get_email.py -n 20000                    # JSON lines, one per mode
+   bench_get_email.py --folders 3 --latency 20 -w 8 -m batched -m parallel
+
+It can also just serve the mailbox, for pointing get_email.py at it with
+SERVER=127.0.0.1, PORT=<port>, SSL=no in config.ini:
+
+   bench_get_email.py --serve --port 1143
+"""
+import argparse
+import contextlib
+import email
+import json
+import platform
+import random
+import re
+import socketserver
+import sys
+import threading
+import tempfile
+import time
+import imaplib
+import os
+from collections import Counter
+
+import get_email
+
+SENDERS = ("alerts", "news", "billing", "jane", "bob", "noreply", "support", "team")
+DOMAINS = ("example.com", "example.org", "mail.example.net", "shop.example", "bank.example")
+SUBJECTS = ("Your statement is ready", "Weekly digest", "Re: lunch?", "Order shipped", "Security alert")
+
+
+def make_mailbox(count, seed):
+  """Full header blocks (bytes) for `count` messages, like a real inbox would have."""
+  rng = random.Random(seed)
+  senders = [(f"{rng.choice(SENDERS)}{i}", rng.choice(DOMAINS)) for i in range(max(count // 20, 1))]
+  messages = []
+  start = 1262304000  # 2010-01-01
+  for i in range(count):
+    user, domain = rng.choice(senders)
+    when = time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime(start + i * 3600 + rng.randrange(3600)))
+    hops = "".join(
+      f"Received: from mx{h}.{domain} (mx{h}.{domain} [192.0.2.{rng.randrange(1, 255)}])\r\n"
+      f"\tby mx.google.com with ESMTPS id {rng.getrandbits(64):x}\r\n\tfor <me@example.com>; {when}\r\n"
+      for h in range(rng.randrange(1, 4)))
+    messages.append((
+      f"Delivered-To: me@example.com\r\n{hops}"
+      f"Message-ID: <{rng.getrandbits(96):x}@{domain}>\r\n"
+      f"Date: {when}\r\n"
+      f"From: \"{user.title()}\" <{user}@{domain}>\r\n"
+      f"To: me@example.com\r\n"
+      f"Subject: {rng.choice(SUBJECTS)}\r\n"
+      f"MIME-Version: 1.0\r\n"
+      f"Content-Type: text/plain; charset=\"UTF-8\"\r\n\r\n").encode('ascii'))
+  return messages
+
+
+def parse_sequence_set(spec, last):
+  """Expand an IMAP sequence set (1:5,7,9:*) against numbers 1..last (the
+  highest UID for UID sets; 'n:*' then matches it even when it is below n)."""
+  nums = []
+  for part in spec.split(','):
+    lo, _, hi = part.partition(':')
+    lo = last if lo == '*' else int(lo)
+    hi = lo if not hi else last if hi == '*' else int(hi)
+    if lo > hi:
+      lo, hi = hi, lo
+    nums.extend(range(max(lo, 1), min(hi, last) + 1))
+  return nums
+
+
+def header_fields(header, fields):
+  """The named fields of a header block plus the blank line, as HEADER.FIELDS returns them."""
+  wanted = {f.lower() for f in fields}
+  out = []
+  keep = False
+  for line in header.split(b'\r\n'):
+    if not line:
+      break
+    if line[:1] in (b' ', b'\t'):
+      if keep:
+        out.append(line)
+      continue
+    keep = line.split(b':', 1)[0].decode('ascii', 'replace').lower() in wanted
+    if keep:
+      out.append(line)
+  return b'\r\n'.join(out) + b'\r\n\r\n' if out else b'\r\n'
+
+
+class Folder:
+  """One mailbox on the stand-in server: header blocks and their UIDs."""
+
+  def __init__(self, messages, uidvalidity=1):
+    self.messages = list(messages)
+    self.uids = list(range(1, len(self.messages) + 1))
+    self.next_uid = len(self.messages) + 1
+    self.uidvalidity = uidvalidity
+
+  def deliver(self, messages):
+    for header in messages:
+      self.messages.append(header)
+      self.uids.append(self.next_uid)
+      self.next_uid += 1
+
+  def expunge(self, count, rng):
+    """Remove `count` random messages, as deleting mail in another client would."""
+    for i in sorted(rng.sample(range(len(self.messages)), count), reverse=True):
+      del self.messages[i]
+      del self.uids[i]
+
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+  FETCH_ITEM = re.compile(r'BODY\.PEEK\[(HEADER|HEADER\.FIELDS \(([^)]*)\))\]', re.I)
+
+  def send(self, data):
+    self.wfile.write(data)
+    with self.server.lock:
+      self.server.stats['bytes_sent'] += len(data)
+
+  def handle(self):
+    self.folder = None
+    self.send(b'* OK [CAPABILITY IMAP4rev1] stand-in server ready\r\n')
+    while True:
+      line = self.rfile.readline()
+      if not line:
+        return
+      with self.server.lock:
+        self.server.stats['commands'] += 1
+        self.server.stats['bytes_received'] += len(line)
+      if self.server.latency:
+        time.sleep(self.server.latency)  # one network round trip
+      tag, _, rest = line.decode('utf-8', 'replace').rstrip('\r\n').partition(' ')
+      command, _, args = rest.partition(' ')
+      handler = getattr(self, 'do_' + command.upper(), None)
+      if handler is None:
+        self.send(f'{tag} BAD unknown command\r\n'.encode())
+        continue
+      if handler(tag, args) is False:
+        return
+
+  def do_CAPABILITY(self, tag, args):
+    self.send(b'* CAPABILITY IMAP4rev1\r\n' + f'{tag} OK CAPABILITY completed\r\n'.encode())
+
+  def do_NOOP(self, tag, args):
+    self.send(f'{tag} OK NOOP completed\r\n'.encode())
+
+  def do_LOGIN(self, tag, args):
+    self.send(f'{tag} OK LOGIN completed\r\n'.encode())
+
+  def do_LIST(self, tag, args):
+    lines = ''.join(f'* LIST (\\HasNoChildren) "/" "{name}"\r\n' for name in self.server.folders)
+    self.send(f'{lines}{tag} OK LIST completed\r\n'.encode())
+
+  def do_SELECT(self, tag, args, command='SELECT', access='READ-WRITE'):
+    name = args.strip()
+    if name.startswith('"'):
+      name = name[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    folder = self.server.folders.get(name)
+    if folder is None:
+      self.folder = None
+      self.send(f'{tag} NO no such mailbox\r\n'.encode())
+      return
+    self.folder = folder
+    self.send(f'* {len(folder.messages)} EXISTS\r\n* 0 RECENT\r\n'
+              f'* FLAGS (\\Seen \\Answered \\Flagged \\Deleted \\Draft)\r\n'
+              f'* OK [UIDVALIDITY {folder.uidvalidity}] UIDs valid\r\n'
+              f'* OK [UIDNEXT {folder.next_uid}] predicted next UID\r\n'
+              f'{tag} OK [{access}] {command} completed\r\n'.encode())
+
+  def do_EXAMINE(self, tag, args):
+    self.do_SELECT(tag, args, 'EXAMINE', 'READ-ONLY')
+
+  def do_SEARCH(self, tag, args, uid=False):
+    if self.folder is None:
+      self.send(f'{tag} BAD no mailbox selected\r\n'.encode())
+      return
+    uids = self.folder.uids
+    if args.upper().startswith('UID '):
+      wanted = set(parse_sequence_set(args[4:], uids[-1] if uids else 0))
+      matches = [(n, u) for n, u in enumerate(uids, 1) if u in wanted]
+    else:
+      matches = list(enumerate(uids, 1))
+    nums = ' '.join(str(u if uid else n) for n, u in matches)
+    self.send(f'* SEARCH {nums}\r\n{tag} OK SEARCH completed\r\n'.encode())
+
+  def do_FETCH(self, tag, args, uid=False):
+    if self.folder is None:
+      self.send(f'{tag} BAD no mailbox selected\r\n'.encode())
+      return
+    with self.server.lock:
+      self.server.fetches += 1
+      drop = self.server.drop_every and self.server.fetches % self.server.drop_every == 0
+    if drop:
+      # a connection lost mid-job; the client has to reconnect
+      with self.server.lock:
+        self.server.stats['dropped'] += 1
+      return False
+    spec, _, items = args.partition(' ')
+    m = self.FETCH_ITEM.search(items)
+    if not m:
+      self.send(f'{tag} BAD unsupported FETCH items\r\n'.encode())
+      return
+    fields = m.group(2).split() if m.group(2) else None
+    section = f'HEADER.FIELDS ({m.group(2).upper()})' if fields else 'HEADER'
+    messages = self.folder.messages
+    uids = self.folder.uids
+    if uid:
+      wanted = set(parse_sequence_set(spec, uids[-1] if uids else 0))
+      nums = [n for n, u in enumerate(uids, 1) if u in wanted]
+    else:
+      nums = parse_sequence_set(spec, len(messages))
+    out = []
+    for num in nums:
+      header = messages[num - 1]
+      body = header_fields(header, fields) if fields else header
+      prefix = f'UID {uids[num - 1]} ' if uid else ''
+      out.append(f'* {num} FETCH ({prefix}BODY[{section}] {{{len(body)}}}\r\n'.encode() + body + b')\r\n')
+    out.append(f'{tag} OK FETCH completed\r\n'.encode())
+    self.send(b''.join(out))
+
+  def do_UID(self, tag, args):
+    command, _, rest = args.partition(' ')
+    handler = {'SEARCH': self.do_SEARCH, 'FETCH': self.do_FETCH}.get(command.upper())
+    if handler is None:
+      self.send(f'{tag} BAD unsupported UID command\r\n'.encode())
+      return
+    return handler(tag, rest, uid=True)
+
+  def do_CLOSE(self, tag, args):
+    self.folder = None
+    self.send(f'{tag} OK CLOSE completed\r\n'.encode())
+
+  def do_LOGOUT(self, tag, args):
+    self.send(b'* BYE logging out\r\n' + f'{tag} OK LOGOUT completed\r\n'.encode())
+    return False
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+  """
+  The stand-in server. `folders` maps mailbox names to header lists. Every
+  command waits `latency` seconds before it is answered. With `drop_every`
+  set, every n-th FETCH closes the connection instead of answering.
+  """
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, folders, address=('127.0.0.1', 0), latency=0.0, drop_every=0):
+    super().__init__(address, IMAPHandler)
+    self.folders = {name: Folder(messages) for name, messages in folders.items()}
+    self.latency = latency
+    self.drop_every = drop_every
+    self.fetches = 0
+    self.lock = threading.Lock()
+    self.stats = {'commands': 0, 'bytes_sent': 0, 'bytes_received': 0, 'dropped': 0}
+
+  @property
+  def inbox(self):
+    return self.folders['INBOX']
+
+  def reset_stats(self):
+    with self.lock:
+      stats = dict(self.stats)
+      for key in self.stats:
+        self.stats[key] = 0
+    return stats
+
+
+def per_message_counts(server):
+  """The old fetch loop: one FETCH of the whole header block per message."""
+  from_count = {}
+  with imaplib.IMAP4(*server.server_address) as M:
+    M.login('bench', 'bench')
+    M.select()
+    typ, data = M.search(None, 'ALL')
+    for num in data[0].split():
+      typ, header_data = M.fetch(num, '(BODY.PEEK[HEADER])')
+      email_message = email.message_from_string(header_data[0][1].decode("utf-8", errors="replace"))
+      from_email = email.utils.parseaddr(email_message['From'])[1]
+      from_count[from_email] = from_count.get(from_email, 0) + 1
+    M.close()
+    M.logout()
+  return from_count
+
+
+def batched_counts(server, capacity=None):
+  host, port = server.server_address
+  with contextlib.redirect_stdout(sys.stderr):  # progress line
+    stats = get_email.fetch_email_counts('bench', 'bench', host=host, port=port, use_ssl=False, capacity=capacity)
+  return stats.sender.counts
+
+
+def parallel_counts(server, workers, capacity=None):
+  host, port = server.server_address
+  with contextlib.redirect_stdout(sys.stderr):
+    stats = get_email.fetch_email_counts_parallel('bench', 'bench', host=host, port=port, use_ssl=False,
+                                                  workers=workers, mailboxes=None, capacity=capacity)
+  return stats.sender.counts
+
+
+def parse_with_email(server):
+  """The old header handling: decode, build an email.message, parseaddr."""
+  counts = {}
+  for header in server.inbox.messages:
+    message = email.message_from_string(header.decode("utf-8", errors="replace"))
+    sender = email.utils.parseaddr(message['From'])[1]
+    counts[sender] = counts.get(sender, 0) + 1
+  return counts
+
+
+def parse_bytes(server):
+  stats = get_email.HeaderStats()
+  for header in server.inbox.messages:
+    stats.add(*get_email.parse_headers(header))
+  return stats.sender.counts
+
+
+def sync_counts(server, store_path, workers=1):
+  host, port = server.server_address
+  store = get_email.CountStore(store_path)
+  try:
+    with contextlib.redirect_stdout(sys.stderr):
+      get_email.sync_email_counts('bench', 'bench', store, host=host, port=port, use_ssl=False,
+                                  mailboxes=None, workers=workers)
+    return store.counts()
+  finally:
+    store.close()
+
+
+def expected_counts(server, names):
+  """Sender counts computed straight from the server's data, to check a run against."""
+  counts = Counter()
+  for name in names:
+    counts.update(get_email.sender_of(header_fields(h, ['From'])) for h in server.folders[name].messages)
+  return counts
+
+
+def timed(fn, server, *args):
+  """Run fn(server, *args) and return (counts, seconds, server stats) for just that call."""
+  server.reset_stats()
+  start = time.perf_counter()
+  counts = fn(server, *args)
+  return counts, time.perf_counter() - start, server.reset_stats()
+
+
+def run_incremental(server, workers):
+  """
+  A full UID sync of every folder, then 1% new and 0.5% expunged mail in the
+  inbox, then the measured incremental sync.
+  """
+  with tempfile.TemporaryDirectory() as tmp:
+    store_path = os.path.join(tmp, 'state.sqlite')
+    sync_counts(server, store_path, workers)
+    inbox = server.inbox
+    rng = random.Random(len(inbox.messages))
+    with server.lock:
+      inbox.expunge(max(len(inbox.messages) // 200, 1), rng)
+      inbox.deliver(make_mailbox(max(len(inbox.messages) // 100, 1), rng.random()))
+    return timed(sync_counts, server, store_path, workers)
+
+
+MODES = ('parse-email', 'parse-bytes', 'per-message', 'batched', 'parallel', 'incremental')
+FOLDER_NAMES = ('INBOX', 'Archive', '[Gmail]/Sent Mail', 'Receipts', 'Lists/python-dev')
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark get_email.py against a local stand-in IMAP server.")
+  parser.add_argument("-n", "--messages", type=int, default=5000, help="Messages per folder (default: 5000)")
+  parser.add_argument("--folders", type=int, default=1, choices=range(1, len(FOLDER_NAMES) + 1),
+                      help="Folders on the server; the parallel and incremental modes cover all of them (default: 1)")
+  parser.add_argument("--seed", type=int, default=1, help="Random seed for the mailbox (default: 1)")
+  parser.add_argument("-m", "--mode", action="append", choices=MODES,
+                      help="Mode to run (can be repeated; default: all)")
+  parser.add_argument("-w", "--workers", type=int, default=4,
+                      help="Connections for the parallel and incremental modes (default: 4)")
+  parser.add_argument("--latency", type=float, default=0.0, metavar="MS",
+                      help="Delay the server adds to every command, in milliseconds (default: 0)")
+  parser.add_argument("--capacity", type=int, default=None, metavar="N",
+                      help="Keep at most N senders and domains in the batched and parallel modes; "
+                           "counts become approximate (default: exact)")
+  parser.add_argument("--drop-every", type=int, default=0, metavar="N",
+                      help="In the parallel mode drop the connection on every N-th FETCH (default: never)")
+  parser.add_argument("--serve", action="store_true", help="Only run the server until interrupted")
+  parser.add_argument("--port", type=int, default=0, help="Port to listen on (default: any free port)")
+  args = parser.parse_args()
+
+  folders = {name: make_mailbox(args.messages, f"{args.seed}:{name}" if i else args.seed)
+             for i, name in enumerate(FOLDER_NAMES[:args.folders])}
+  server = FakeIMAPServer(folders, ('127.0.0.1', args.port), latency=args.latency / 1000)
+  host, port = server.server_address
+  if args.serve:
+    server.drop_every = args.drop_every
+    print(f"Serving {args.folders} folders of {args.messages} messages on {host}:{port}")
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    return
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  print(json.dumps({
+    'type': 'meta',
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'messages': args.messages,
+    'folders': args.folders,
+    'latency_ms': args.latency,
+    'workers': args.workers,
+    'seed': args.seed,
+  }), flush=True)
+  for mode in args.mode or MODES:
+    names = ['INBOX']
+    if mode == 'parse-email':
+      # whole header blocks, no network: the parsing cost alone
+      counts, wall, stats = timed(parse_with_email, server)
+    elif mode == 'parse-bytes':
+      counts, wall, stats = timed(parse_bytes, server)
+    elif mode == 'per-message':
+      counts, wall, stats = timed(per_message_counts, server)
+    elif mode == 'batched':
+      counts, wall, stats = timed(batched_counts, server, args.capacity)
+    elif mode == 'parallel':
+      names = list(server.folders)
+      server.drop_every = args.drop_every
+      try:
+        counts, wall, stats = timed(parallel_counts, server, args.workers, args.capacity)
+      finally:
+        server.drop_every = 0
+    else:
+      names = list(server.folders)
+      counts, wall, stats = run_incremental(server, args.workers)
+    messages = sum(len(server.folders[name].messages) for name in names)
+    print(json.dumps({
+      'type': 'run',
+      'mode': mode,
+      'messages': messages,
+      'seconds': round(wall, 4),
+      'messages_per_s': round(messages / wall) if wall else None,
+      'round_trips': stats['commands'],
+      'bytes_sent': stats['bytes_sent'],
+      'bytes_received': stats['bytes_received'],
+      'dropped_connections': stats['dropped'],
+      'senders': len(counts),
+      'counts_match': Counter(counts) == expected_counts(server, names),
+    }), flush=True)
+  server.shutdown()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Benchmark find_dupes.py against reproducible synthetic trees.
+
+Generates one tree per scenario (same seed -> same bytes), then runs
+find_dupes.py over it with cold and warm page cache, with and without a
+primed --cache-file, and with one and several workers. Every run is written
+as one JSON object per line so results from two versions can be diffed:
+
+   bench_find_dupes.py --tree /tmp/fdbench > before.jsonl
+   (change find_dupes.py)
+   bench_find_dupes.py --tree /tmp/fdbench > after.jsonl
+
+Bytes and syscall counts come from /proc/<pid>/io (Linux), peak RSS from
+wait4(). "Cold" drops each file's pages with posix_fadvise(DONTNEED), which
+needs no root but only evicts clean pages, so trees are synced first; warm
+runs pass --keep-page-cache so find_dupes.py does not evict what it read.
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import platform
+import subprocess
+import time
+
+MiB = 1024 * 1024
+
+
+def _write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def _write_big(path, size, rng, chunk=MiB):
+    """Write `size` pseudo-random bytes without holding them all in memory."""
+    with open(path, 'wb') as f:
+        left = size
+        while left:
+            n = min(chunk, left)
+            f.write(rng.randbytes(n))
+            left -= n
+
+
+def gen_tiny(root, rng, scale):
+    """Many tiny files in many directories; roughly one in ten is a copy."""
+    count = int(20000 * scale)
+    pool = [rng.randbytes(rng.randrange(1, 512)) for _ in range(max(count // 10, 1))]
+    for i in range(count):
+        d = os.path.join(root, f"d{i % 200:03d}")
+        os.makedirs(d, exist_ok=True)
+        data = rng.choice(pool) if rng.random() < 0.1 else rng.randbytes(rng.randrange(1, 512))
+        _write(os.path.join(d, f"f{i}"), data)
+
+
+def gen_huge(root, rng, scale):
+    """A few huge files: one identical pair and two that differ only in the middle."""
+    size = max(int(256 * MiB * scale), MiB)
+    os.makedirs(root, exist_ok=True)
+    data_seed = rng.random()
+    for name in ("a.bin", "b.bin", "c.bin", "d.bin"):
+        _write_big(os.path.join(root, name), size, random.Random(data_seed))
+    # a and b stay identical; c and d get one different byte in the middle
+    for name, byte in (("c.bin", b'\x01'), ("d.bin", b'\x02')):
+        with open(os.path.join(root, name), 'r+b') as f:
+            f.seek(size // 2)
+            f.write(byte)
+
+
+def gen_collisions(root, rng, scale):
+    """Lots of files of exactly the same size with (mostly) different content."""
+    count = int(2000 * scale)
+    size = 64 * 1024
+    os.makedirs(root, exist_ok=True)
+    previous = None
+    for i in range(count):
+        data = previous if previous is not None and rng.random() < 0.05 else rng.randbytes(size)
+        _write(os.path.join(root, f"same{i:05d}"), data)
+        previous = data
+
+
+def gen_deep(root, rng, scale):
+    """Files spread along deep directory chains."""
+    count = int(5000 * scale)
+    for i in range(count):
+        depth = 10 + i % 40
+        d = os.path.join(root, *(f"l{j}_{i % 7}" for j in range(depth)))
+        os.makedirs(d, exist_ok=True)
+        _write(os.path.join(d, f"f{i}"), rng.randbytes(rng.randrange(1, 4096)))
+
+
+def gen_hardlinks(root, rng, scale):
+    """Files with several hard links each, plus a few real copies."""
+    count = int(2000 * scale)
+    os.makedirs(os.path.join(root, "data"), exist_ok=True)
+    os.makedirs(os.path.join(root, "links"), exist_ok=True)
+    for i in range(count):
+        path = os.path.join(root, "data", f"f{i}")
+        _write(path, rng.randbytes(rng.randrange(1024, 16384)))
+        for j in range(3):
+            os.link(path, os.path.join(root, "links", f"f{i}.{j}"))
+
+
+def gen_headtail(root, rng, scale):
+    """Same-size files that share head and tail and differ only in the middle."""
+    count = int(200 * scale)
+    size = max(int(4 * MiB * scale), 64 * 1024)
+    os.makedirs(root, exist_ok=True)
+    head = rng.randbytes(8192)
+    tail = rng.randbytes(8192)
+    middle = size - len(head) - len(tail)
+    for i in range(count):
+        # every tenth file has an all-zero middle, so those are real duplicates
+        body = rng.randbytes(middle) if i % 10 else bytes(middle)
+        _write(os.path.join(root, f"ht{i:04d}"), head + body + tail)
+
+
+SCENARIOS = {
+    'tiny': gen_tiny,
+    'huge': gen_huge,
+    'collisions': gen_collisions,
+    'deep': gen_deep,
+    'hardlinks': gen_hardlinks,
+    'headtail': gen_headtail,
+}
+
+
+def ensure_tree(base, name, seed, scale):
+    """Create the scenario tree unless a complete one with the same parameters exists."""
+    root = os.path.join(base, name)
+    stamp = os.path.join(base, f".{name}.json")
+    params = {'seed': seed, 'scale': scale}
+    try:
+        with open(stamp, encoding='utf-8') as f:
+            if json.load(f) == params:
+                return root
+    except (OSError, ValueError):
+        pass
+    if os.path.exists(root):
+        subprocess.run(["rm", "-rf", root], check=True)
+    rng = random.Random(f"{seed}:{name}")
+    SCENARIOS[name](root, rng, scale)
+    with open(stamp, 'w', encoding='utf-8') as f:
+        json.dump(params, f)
+    return root
+
+
+def tree_stats(root):
+    files = 0
+    total = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            st = os.lstat(os.path.join(dirpath, name))
+            files += 1
+            total += st.st_size
+    return files, total
+
+
+def drop_page_cache(root):
+    """Ask the kernel to evict every file below `root` from the page cache."""
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            try:
+                fd = os.open(os.path.join(dirpath, name), os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+    return True
+
+
+def read_proc_io(pid):
+    counters = {}
+    try:
+        with open(f"/proc/{pid}/io", encoding='ascii') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                counters[key] = int(value)
+    except OSError:
+        pass
+    return counters
+
+
+def run_tool(cmd):
+    """Run `cmd` with its output discarded and return (exit code, wall seconds, /proc io, rusage)."""
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # wait without reaping so /proc/<pid>/io is still readable, then reap for rusage
+    os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+    wall = time.perf_counter() - start
+    io = read_proc_io(proc.pid)
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode, wall, io, usage
+
+
+def revision(path):
+    try:
+        return subprocess.run(["git", "-C", os.path.dirname(os.path.abspath(path)), "describe",
+                               "--always", "--dirty"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Benchmark find_dupes.py on synthetic trees (JSON lines output).")
+    parser.add_argument("--tree", default="/tmp/find_dupes_bench",
+                        help="Where the synthetic trees are generated and reused (default: /tmp/find_dupes_bench)")
+    parser.add_argument("-s", "--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="Scenario to run (can be repeated; default: all)")
+    parser.add_argument("--scale", type=float, default=0.1,
+                        help="Multiplier for file counts and sizes (default: 0.1, a quick run)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for tree contents (default: 1)")
+    parser.add_argument("--tool", default=os.path.join(here, "find_dupes.py"),
+                        help="find_dupes.py to benchmark (default: the one next to this script)")
+    parser.add_argument("-w", "--workers", type=int, default=4,
+                        help="Worker count for the parallel runs (default: 4)")
+    parser.add_argument("-r", "--repeat", type=int, default=1, help="Runs per configuration (default: 1)")
+    parser.add_argument("-o", "--output", default=None, help="Write JSON lines here instead of stdout")
+    parser.add_argument("--generate-only", action="store_true", help="Only create the trees")
+    parser.add_argument("tool_args", nargs="*", help="Extra arguments for find_dupes.py (after --)")
+    args = parser.parse_args()
+
+    out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        os.makedirs(args.tree, exist_ok=True)
+        meta = {
+            'type': 'meta',
+            'tool': os.path.abspath(args.tool),
+            'revision': revision(args.tool),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'scale': args.scale,
+        }
+        print(json.dumps(meta), file=out, flush=True)
+
+        for name in args.scenario or sorted(SCENARIOS):
+            root = ensure_tree(args.tree, name, args.seed, args.scale)
+            # fadvise(DONTNEED) skips dirty pages; flush a freshly written tree
+            os.sync()
+            if args.generate_only:
+                continue
+            files, total = tree_stats(root)
+            index = os.path.join(args.tree, f".{name}.index")
+            for page_cache in ("cold", "warm"):
+                for use_index in (False, True):
+                    for workers in sorted({1, args.workers}):
+                        cmd = [sys.executable, args.tool, root, "-w", str(workers)] + args.tool_args
+                        if page_cache == "warm":
+                            # otherwise the warm-up run drops the pages it just read
+                            cmd.append("--keep-page-cache")
+                        if use_index:
+                            for suffix in ("", "-wal", "-shm"):
+                                if os.path.exists(index + suffix):
+                                    os.unlink(index + suffix)
+                            cmd += ["--cache-file", index]
+                            # prime the index; only the rerun is measured
+                            run_tool(cmd)
+                        for _ in range(args.repeat):
+                            if page_cache == "cold":
+                                drop_page_cache(root)
+                            else:
+                                run_tool(cmd)
+                            code, wall, io, usage = run_tool(cmd)
+                            result = {
+                                'type': 'run',
+                                'scenario': name,
+                                'page_cache': page_cache,
+                                'index': 'primed' if use_index else 'none',
+                                'workers': workers,
+                                'keep_page_cache': "--keep-page-cache" in cmd,
+                                'files': files,
+                                'bytes_total': total,
+                                'exit': code,
+                                'wall_s': round(wall, 4),
+                                'cpu_s': round(usage.ru_utime + usage.ru_stime, 4),
+                                'files_per_s': round(files / wall, 1) if wall else None,
+                                'bytes_read': io.get('rchar'),
+                                'storage_bytes_read': io.get('read_bytes'),
+                                'read_syscalls': io.get('syscr'),
+                                'write_syscalls': io.get('syscw'),
+                                'max_rss_kb': usage.ru_maxrss,
+                            }
+                            print(json.dumps(result), file=out, flush=True)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for the date extraction in fix_dates.py.
+
+Generates a reproducible list of file names in the layouts fix_dates.py sees
+(2015.03.19, 15-03-19, 03 19 2015, 20150319, ...), with dates repeating the
+way they do in a photo or scan archive, and times:
+
+   dateutil   the old path: two fuzzy dateutil parses per name
+   fast       process_file with an empty memo (precompiled patterns)
+   memo       process_file again, every token already memoized
+   rename     os.rename of the same number of empty files in a temporary
+              directory, the filesystem cost the parser should stay below
+
+Each result is one JSON object per line, so two versions can be diffed.
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import platform
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fix_dates  # noqa: E402
+
+LAYOUTS = (
+    "{Y:04d}.{m:02d}.{d:02d}",
+    "{Y:04d}-{m:02d}-{d:02d}",
+    "{Y:04d}_{m:02d}_{d:02d}",
+    "{y:02d}.{m:02d}.{d:02d}",
+    "{y:02d} {m:02d} {d:02d}",
+    "{m:02d}.{d:02d}.{Y:04d}",
+    "{m:02d}-{d:02d}-{Y:04d}",
+    "{Y:04d}{m:02d}{d:02d}",
+    "{y:02d}{m:02d}{d:02d}",
+)
+PREFIXES = ("IMG_", "scan ", "Statement-", "DSC", "receipt_", "")
+
+
+def make_names(count, distinct_dates, rng):
+    dates = [(rng.randrange(1995, 2026), rng.randrange(1, 13), rng.randrange(1, 29)) for _ in range(distinct_dates)]
+    names = []
+    for i in range(count):
+        Y, m, d = rng.choice(dates)
+        stamp = rng.choice(LAYOUTS).format(Y=Y, y=Y % 100, m=m, d=d)
+        names.append(f"{rng.choice(PREFIXES)}{stamp}_{i}.jpg")
+    return names
+
+
+def old_process_file(file):
+    """The pre-fast-path extraction: one fuzzy parse, then another in reformat_date."""
+    possible_date = fix_dates.DATE_TOKEN.search(file)
+    if not possible_date:
+        return None
+    try:
+        fulldate = fix_dates.parser.parse(possible_date.group(0), fuzzy=True, yearfirst=True).strftime("%Y-%m-%d")
+    except ValueError:
+        return None
+    date = fix_dates.reformat_date(fulldate)
+    return f"{date}_{file}" if date else None
+
+
+def timed(fn, names):
+    start = time.perf_counter()
+    for name in names:
+        fn(name)
+    return time.perf_counter() - start
+
+
+def time_renames(count):
+    base = tempfile.mkdtemp(prefix="bench_fix_dates.")
+    try:
+        for i in range(count):
+            open(os.path.join(base, f"f{i}"), 'wb').close()
+        start = time.perf_counter()
+        for i in range(count):
+            os.rename(os.path.join(base, f"f{i}"), os.path.join(base, f"r{i}"))
+        return time.perf_counter() - start
+    finally:
+        shutil.rmtree(base)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark fix_dates.py date extraction (JSON lines output).")
+    parser.add_argument("-n", "--names", type=int, default=100000, help="File names to parse (default: 100000)")
+    parser.add_argument("--dates", type=int, default=2000, help="Distinct dates among them (default: 2000)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+    parser.add_argument("--dateutil-names", type=int, default=10000,
+                        help="Names for the slow dateutil run, timed separately and scaled (default: 10000)")
+    parser.add_argument("--no-rename", action="store_true", help="Skip the os.rename baseline")
+    args = parser.parse_args()
+
+    names = make_names(args.names, args.dates, random.Random(args.seed))
+    print(json.dumps({
+        'type': 'meta',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'names': len(names),
+        'dates': args.dates,
+        'seed': args.seed,
+        'dateutil': fix_dates.parser is not None,
+    }), flush=True)
+
+    def report(mode, count, seconds):
+        print(json.dumps({
+            'type': 'run',
+            'mode': mode,
+            'names': count,
+            'seconds': round(seconds, 4),
+            'names_per_s': round(count / seconds) if seconds else None,
+        }), flush=True)
+
+    if fix_dates.parser is not None and args.dateutil_names:
+        sample = names[:args.dateutil_names]
+        report('dateutil', len(sample), timed(old_process_file, sample))
+    fix_dates.token_date.cache_clear()
+    report('fast', len(names), timed(fix_dates.process_file, names))
+    report('memo', len(names), timed(fix_dates.process_file, names))
+    if not args.no_rename:
+        report('rename', len(names), time_renames(len(names)))
+
+
+if __name__ == "__main__":
+    main()
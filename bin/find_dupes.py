@@ -3,36 +3,152 @@
 Script to find duplicate files recursively.
 By default, for each duplicate file it outputs:
    newer_file ; duplicate of older_file
+and for every extra hard link to a file it has already seen:
+   link_path ; hardlink of first_path
 If the "-1" flag is set, only the duplicate (newer) file path is printed.
 Optimized by first grouping files by file size.
 """
 import os
 import hashlib
 import argparse
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import select
+import signal
+import socket
 import sys
 import fnmatch
+import functools
+import heapq
+import itertools
 import json
 import logging
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import re
+import sqlite3
+import stat
+import struct
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-def compute_hash(filepath, block_size=65536):
-    hasher = hashlib.sha256()
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+try:
+    import xxhash  # optional, much faster than any cryptographic digest
+except ImportError:
+    xxhash = None
+
+# Digest constructors selectable with --hash-algo.
+HASH_ALGOS = {
+    'sha256': hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+    'sha1': hashlib.sha1,
+    'md5': hashlib.md5,
+}
+if xxhash is not None:
+    HASH_ALGOS.update({
+        'xxh64': xxhash.xxh64,
+        'xxh3_64': xxhash.xxh3_64,
+        'xxh128': xxhash.xxh3_128,
+    })
+
+HEAD_BYTES = 4096
+TAIL_BYTES = 4096
+SAMPLE_BLOCK = 65536
+SAMPLE_FIRST_OFFSET = 1 << 20
+
+
+def new_hasher(algo='sha256'):
+    return HASH_ALGOS[algo]()
+
+
+# Full-file reads: block size bounds, and how much to read before dropping
+# already-hashed pages from the page cache.
+MIN_BLOCK = 64 * 1024
+MAX_BLOCK = 8 * 1024 * 1024
+DROP_WINDOW = 32 * 1024 * 1024
+
+_buffers = threading.local()
+
+
+def _read_buffer(size):
+    """Per-thread reusable read buffer of at least `size` bytes, as a memoryview."""
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None or len(buf) < size:
+        buf = _buffers.buf = bytearray(size)
+    return memoryview(buf)[:size]
+
+
+def _fadvise(fd, offset, length, advice):
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+
+def pick_block_size(size, fs_blksize=0):
+    """Read size for a file: small files get one small read, big files get 1 MiB
+    reads, and filesystems that prefer larger I/O (NFS, SMB) get their st_blksize.
+    """
+    if size < 1024 * 1024:
+        block = MIN_BLOCK
+    elif size < 64 * 1024 * 1024:
+        block = 256 * 1024
+    else:
+        block = 1024 * 1024
+    return min(max(block, fs_blksize), MAX_BLOCK)
+
+
+def compute_hash(filepath, block_size=None, algo='sha256', drop_cache=False):
+    """Hash a whole file, reading into a reused buffer instead of allocating per block.
+    With `drop_cache` the kernel is told to drop the file's pages once they have been
+    hashed, so hashing a large tree does not evict everything else from the page cache.
+    Returns hex digest or None on error.
+    """
+    hasher = new_hasher(algo)
     try:
-        with open(filepath, 'rb') as f:
-            for block in iter(lambda: f.read(block_size), b''):
-                hasher.update(block)
+        with open(filepath, 'rb', buffering=0) as f:
+            fd = f.fileno()
+            if block_size is None:
+                st = os.fstat(fd)
+                block_size = pick_block_size(st.st_size, st.st_blksize)
+            view = _read_buffer(block_size)
+            if hasattr(os, 'POSIX_FADV_SEQUENTIAL'):
+                _fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            drop_cache = drop_cache and hasattr(os, 'POSIX_FADV_DONTNEED')
+            pos = dropped = 0
+            while True:
+                n = f.readinto(view)
+                if not n:
+                    break
+                hasher.update(view[:n])
+                pos += n
+                if drop_cache and pos - dropped >= DROP_WINDOW:
+                    _fadvise(fd, dropped, pos - dropped, os.POSIX_FADV_DONTNEED)
+                    dropped = pos
+            if drop_cache:
+                _fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
     except Exception as e:
-        print(f"Error reading {filepath}: {e}")
+        print(f"Error reading {filepath}: {e}", file=sys.stderr)
         return None
     return hasher.hexdigest()
 
 
-def compute_partial_hash(filepath, head_bytes=4096, tail_bytes=4096):
+def compute_partial_hash(filepath, head_bytes=HEAD_BYTES, tail_bytes=TAIL_BYTES, size=None, algo='sha256'):
     """Compute a small fingerprint using head+tail bytes to prefilter identical files.
-    Returns hex digest of SHA256(head + tail) or None on error.
+    Pass `size` when it is already known to avoid another stat call.
+    Returns hex digest of HASH(head + tail) or None on error.
     """
     try:
-        size = os.path.getsize(filepath)
+        if size is None:
+            size = os.path.getsize(filepath)
         with open(filepath, 'rb') as f:
             head = f.read(head_bytes)
             if size > head_bytes + tail_bytes:
@@ -42,7 +158,7 @@ def compute_partial_hash(filepath, head_bytes=4096, tail_bytes=4096):
                 # file small enough, read all
                 f.seek(0)
                 tail = f.read()
-        h = hashlib.sha256()
+        h = new_hasher(algo)
         h.update(head)
         h.update(tail)
         return h.hexdigest()
@@ -53,10 +169,1468 @@ def compute_partial_hash(filepath, head_bytes=4096, tail_bytes=4096):
             print(f"Error reading for partial hash: {e}", file=sys.stderr)
         return None
 
-def find_files(root, follow_symlinks=False):
-    for dirpath, _, filenames in os.walk(root, followlinks=follow_symlinks):
-        for fname in filenames:
-            yield os.path.join(dirpath, fname)
+
+def sample_offsets(size, block_size=SAMPLE_BLOCK, first=SAMPLE_FIRST_OFFSET):
+    """Offsets of the blocks read by the sample stage: 1 MiB, 4 MiB, 16 MiB, ...
+    growing by 4x through the file, plus the midpoint.
+    """
+    offsets = set()
+    offset = first
+    while offset + block_size <= size:
+        offsets.add(offset)
+        offset *= 4
+    if size >= 2 * block_size:
+        offsets.add(size // 2 - block_size // 2)
+    return sorted(offsets)
+
+
+def compute_sampled_hash(filepath, size, block_size=SAMPLE_BLOCK, algo='sha256'):
+    """Hash blocks at growing offsets (see sample_offsets). Returns hex digest or None on error."""
+    try:
+        h = new_hasher(algo)
+        with open(filepath, 'rb') as f:
+            for offset in sample_offsets(size, block_size):
+                f.seek(offset)
+                h.update(f.read(block_size))
+        return h.hexdigest()
+    except Exception as e:
+        print(f"Error reading for sampled hash {filepath}: {e}", file=sys.stderr)
+        return None
+
+
+class Stage:
+    """One comparison stage: which bytes of a file get hashed, and with which digest.
+
+    'headtail' reads HEAD_BYTES + TAIL_BYTES, 'sample' reads SAMPLE_BLOCK bytes at
+    growing offsets, 'full' reads everything. Stages are picklable so they can be
+    shipped to process workers.
+    """
+    NAMES = ('headtail', 'sample', 'full')
+    __slots__ = ('name', 'algo', 'drop_cache')
+
+    def __init__(self, name, algo='sha256', drop_cache=False):
+        if name not in self.NAMES:
+            raise ValueError(f"unknown stage {name!r}")
+        self.name = name
+        self.algo = algo
+        self.drop_cache = drop_cache
+
+    @property
+    def key(self):
+        """Identifies the digest in the hash index."""
+        return f"{self.name}:{self.algo}"
+
+    def applies(self, size):
+        """False when this stage cannot tell files of `size` apart any better than the previous one."""
+        if self.name == 'sample':
+            return size >= SAMPLE_FIRST_OFFSET + SAMPLE_BLOCK
+        return True
+
+    def covers(self, size):
+        """True when this stage has hashed every byte of a file of `size`."""
+        if self.name == 'headtail':
+            return size <= HEAD_BYTES + TAIL_BYTES
+        return self.name == 'full'
+
+    def read_bytes(self, size):
+        """Bytes compute() reads from a file of `size`."""
+        if self.name == 'headtail':
+            if size > HEAD_BYTES + TAIL_BYTES:
+                return HEAD_BYTES + TAIL_BYTES
+            return min(size, HEAD_BYTES) + size
+        if self.name == 'sample':
+            return len(sample_offsets(size)) * SAMPLE_BLOCK
+        return size
+
+    def compute(self, path, size):
+        if self.name == 'headtail':
+            return compute_partial_hash(path, size=size, algo=self.algo)
+        if self.name == 'sample':
+            return compute_sampled_hash(path, size, algo=self.algo)
+        return compute_hash(path, algo=self.algo, drop_cache=self.drop_cache)
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, {self.algo!r})"
+
+
+# Comparison stages, cheapest first. A file only reaches a stage while it still
+# collides with another file on every earlier stage.
+DEFAULT_STAGES = ('headtail', 'sample', 'full')
+
+
+def build_stages(names=DEFAULT_STAGES, algo='sha256', drop_cache=False):
+    """Turn stage names into Stage objects; the last stage must be 'full'."""
+    names = list(names)
+    if not names or names[-1] != 'full' or names.count('full') != 1:
+        raise ValueError("stages must end with 'full'")
+    if len(set(names)) != len(names):
+        raise ValueError("stages must not repeat")
+    return [Stage(name, algo, drop_cache) for name in names]
+
+
+def hash_task(stage, path, size):
+    """Compute the digest for one stage. Runs in pool workers, so it must stay picklable.
+    Returns (digest, seconds taken, worker name).
+    """
+    start = time.perf_counter()
+    digest = stage.compute(path, size)
+    worker = f"{os.getpid()}/{threading.current_thread().name}"
+    return digest, time.perf_counter() - start, worker
+
+
+class HashCache:
+    """Persistent digest index stored in SQLite.
+
+    Entries are keyed by (device, inode, stage key) and only count as hits while
+    the file's size and mtime_ns still match, so renames and moves keep their
+    digests and rewritten files are rehashed. Every stage digest is stored
+    (head+tail, sampled, full), each under its own key. Writes are committed
+    in small batches, so a run that is interrupted keeps everything it hashed
+    up to that point.
+    """
+
+    def __init__(self, path, commit_every=1000, commit_interval=5.0):
+        self.path = path
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self._pending = 0
+        self._last_commit = time.monotonic()
+        self.conn = sqlite3.connect(path)
+        try:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS digests ("
+                " dev INTEGER NOT NULL,"
+                " ino INTEGER NOT NULL,"
+                " kind TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " mtime_ns INTEGER NOT NULL,"
+                " digest TEXT NOT NULL,"
+                " PRIMARY KEY (dev, ino, kind)"
+                ") WITHOUT ROWID"
+            )
+            self.conn.commit()
+        except sqlite3.DatabaseError:
+            self.conn.close()
+            raise
+
+    def get(self, rec, kind):
+        """Return the cached digest of `kind` for FileRecord `rec`, or None."""
+        row = self.conn.execute(
+            "SELECT size, mtime_ns, digest FROM digests WHERE dev = ? AND ino = ? AND kind = ?",
+            (rec.dev, rec.ino, kind),
+        ).fetchone()
+        if row and row[0] == rec.size and row[1] == rec.mtime_ns:
+            return row[2]
+        return None
+
+    def put(self, rec, kind, digest):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO digests (dev, ino, kind, size, mtime_ns, digest) VALUES (?, ?, ?, ?, ?, ?)",
+            (rec.dev, rec.ino, kind, rec.size, rec.mtime_ns, digest),
+        )
+        self._pending += 1
+        if (self._pending >= self.commit_every
+                or time.monotonic() - self._last_commit >= self.commit_interval):
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self._pending = 0
+        self._last_commit = time.monotonic()
+
+    def close(self):
+        try:
+            self.commit()
+        finally:
+            self.conn.close()
+
+
+class FileRecord:
+    """Metadata for one scanned file, taken from a single stat call.
+
+    The directory string is shared by every record from the same directory, so
+    a record costs its file name rather than its full path.
+    """
+    __slots__ = ('dir', 'name', 'size', 'mtime_ns', 'dev', 'ino', 'nlink')
+
+    def __init__(self, dir, name, size, mtime_ns, dev, ino, nlink=1):
+        self.dir = dir
+        self.name = name
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.dev = dev
+        self.ino = ino
+        self.nlink = nlink
+
+    @classmethod
+    def from_stat(cls, dir, name, st):
+        return cls(dir, name, st.st_size, st.st_mtime_ns, st.st_dev, st.st_ino, st.st_nlink)
+
+    @property
+    def path(self):
+        return os.path.join(self.dir, self.name)
+
+    def __repr__(self):
+        return f"FileRecord({self.path!r}, size={self.size})"
+
+
+def _compile_globs(patterns):
+    """One regex matcher for a list of fnmatch patterns, or None for an empty list."""
+    if not patterns:
+        return None
+    return re.compile("|".join(fnmatch.translate(p) for p in patterns)).match
+
+
+def parse_time(value):
+    """Parse an --newer-than/--older-than value into epoch nanoseconds.
+
+    Accepts an age such as '90m', '12h', '7d' or '2w', or an ISO date/time.
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([smhdw])', value.strip())
+    if match:
+        return time.time_ns() - int(float(match.group(1)) * units[match.group(2)] * 1e9)
+    return int(datetime.fromisoformat(value).timestamp() * 1e9)
+
+
+class PathFilter:
+    """Include/exclude patterns and size/mtime limits, compiled once and applied
+    during the walk.
+
+    Exclude patterns keep their meaning of fnmatch against the full path. A
+    pattern ending in '/' is a directory rule in the gitignore sense: without
+    another '/' it matches a directory name anywhere ('node_modules/'),
+    otherwise the directory's full path. Directories matched by a rule are
+    pruned without being listed, and so are directories whose every file would
+    be excluded anyway: a full-path pattern ending in '*' (like '*/.git/*')
+    that matches 'dir/'. Include patterns, if any, must match a file's full
+    path. Size and mtime limits use the stat result the walk already has.
+    """
+
+    def __init__(self, exclude=(), include=(), min_size=0, max_size=None, newer_than_ns=None,
+                 older_than_ns=None):
+        file_patterns = [p for p in exclude if not p.endswith('/')]
+        dir_rules = [p.rstrip('/') for p in exclude if p.endswith('/') and p.rstrip('/')]
+        self._exclude = _compile_globs(file_patterns)
+        self._include = _compile_globs(list(include))
+        self._prune_tree = _compile_globs([p for p in file_patterns if p.endswith('*')])
+        self._prune_path = _compile_globs([p for p in dir_rules if '/' in p])
+        self._prune_name = _compile_globs([p for p in dir_rules if '/' not in p])
+        self.min_size = min_size
+        self.max_size = max_size
+        self.newer_than_ns = newer_than_ns
+        self.older_than_ns = older_than_ns
+
+    def prune(self, path, name):
+        """True when the directory at `path` should not be descended into."""
+        return bool((self._prune_name and self._prune_name(name))
+                    or (self._prune_path and self._prune_path(path))
+                    or (self._prune_tree and self._prune_tree(os.path.join(path, ''))))
+
+    def skip_path(self, path):
+        """True when a file is excluded by its path alone, before any stat."""
+        if self._exclude and self._exclude(path):
+            return True
+        return bool(self._include and not self._include(path))
+
+    def skip_stat(self, size, mtime_ns):
+        if size < self.min_size or (self.max_size is not None and size > self.max_size):
+            return True
+        if self.newer_than_ns is not None and mtime_ns < self.newer_than_ns:
+            return True
+        return self.older_than_ns is not None and mtime_ns > self.older_than_ns
+
+    def accept_dir(self, path, root=None):
+        """False when `path` or any directory above it would have been pruned.
+
+        Like the walk, which never tests the directories it starts from, the
+        check stops at `root` when given.
+        """
+        root = os.path.normpath(root) if root is not None else None
+        for d in _parents(path):
+            if d == root:
+                return True
+            if self.prune(d, os.path.basename(d)):
+                return False
+        return True
+
+    def accept(self, rec, root=None):
+        """Full check for a record that did not come from the walk (e.g. --watch events)."""
+        return (self.accept_dir(rec.dir, root) and not self.skip_path(rec.path)
+                and not self.skip_stat(rec.size, rec.mtime_ns))
+
+
+def _parents(path):
+    """`path` and each of its parent directories, innermost first."""
+    while True:
+        yield path
+        parent = os.path.dirname(path)
+        if not parent or parent == path:
+            return
+        path = parent
+
+
+def _scan_dir(path, follow_symlinks, path_filter=None):
+    """List one directory. Returns (file records, subdirectory DirEntry objects, Counter).
+
+    Regular files (and symlinks to them, as os.walk + isfile used to report) are
+    stat()ed exactly once via DirEntry.stat(), which caches its result. With a
+    PathFilter, pruned directories are left out and files excluded by path are
+    dropped before they are stat()ed.
+    """
+    records = []
+    subdirs = []
+    counts = Counter()
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=follow_symlinks):
+                        if path_filter and path_filter.prune(entry.path, entry.name):
+                            logging.debug(f"Pruning {entry.path} (matched exclude pattern)")
+                            counts['pruned'] += 1
+                        else:
+                            subdirs.append(entry)
+                    elif entry.is_file():
+                        if path_filter and path_filter.skip_path(entry.path):
+                            counts['skipped'] += 1
+                            continue
+                        st = entry.stat()
+                        if path_filter and path_filter.skip_stat(st.st_size, st.st_mtime_ns):
+                            counts['skipped'] += 1
+                            continue
+                        records.append(FileRecord.from_stat(path, entry.name, st))
+                except OSError as e:
+                    logging.error(f"Error reading {entry.path}: {e}")
+                    counts['errors'] += 1
+    except OSError as e:
+        logging.error(f"Error listing {path}: {e}")
+        counts['errors'] += 1
+    return records, subdirs, counts
+
+
+def scan_tree(roots, follow_symlinks=False, threads=1, on_dir=None, counters=None, path_filter=None):
+    """Yield a FileRecord for every regular file below the given root directories.
+
+    With threads > 1 directories are listed concurrently on a thread pool, which
+    hides per-directory metadata latency on network filesystems. When following
+    symlinks, directories already visited (by device and inode) are skipped so
+    link cycles terminate. `on_dir` is called with each directory path before
+    it is listed, from the calling thread. Directories listed, files skipped
+    or pruned by `path_filter` and read errors are added to `counters` when given.
+    """
+    if counters is None:
+        counters = Counter()
+    seen_dirs = set()
+
+    def want(entry_or_path):
+        if follow_symlinks:
+            try:
+                st = os.stat(entry_or_path)
+            except OSError:
+                return False
+            key = (st.st_dev, st.st_ino)
+            if key in seen_dirs:
+                logging.debug(f"Skipping {os.fspath(entry_or_path)} (directory already visited)")
+                return False
+            seen_dirs.add(key)
+        if on_dir:
+            on_dir(os.fspath(entry_or_path))
+        return True
+
+    pending = [root for root in roots if want(root)]
+    if threads <= 1:
+        while pending:
+            records, subdirs, counts = _scan_dir(pending.pop(), follow_symlinks, path_filter)
+            counters['directories scanned'] += 1
+            counters.update(counts)
+            yield from records
+            pending.extend(d.path for d in reversed(subdirs) if want(d))
+        return
+
+    with ThreadPoolExecutor(max_workers=threads) as ex:
+        futures = {ex.submit(_scan_dir, d, follow_symlinks, path_filter) for d in pending}
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for fut in done:
+                records, subdirs, counts = fut.result()
+                counters['directories scanned'] += 1
+                counters.update(counts)
+                for d in subdirs:
+                    if want(d):
+                        futures.add(ex.submit(_scan_dir, d.path, follow_symlinks, path_filter))
+                yield from records
+
+
+class _GroupState:
+    """Bookkeeping for one candidate group while its members are hashed for a stage."""
+    __slots__ = ('stage', 'remaining', 'buckets')
+
+    def __init__(self, stage, remaining):
+        self.stage = stage
+        self.remaining = remaining
+        self.buckets = {}
+
+
+# FIEMAP ioctl (linux/fiemap.h): a header followed by extent records.
+FS_IOC_FIEMAP = 0xC020660B
+_FIEMAP_HEADER = struct.Struct('=QQLLLL')   # start, length, flags, mapped_extents, extent_count, reserved
+_FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')  # logical, physical, length, reserved64[2], flags, reserved[3]
+
+
+@functools.lru_cache(maxsize=65536)
+def physical_offset(path):
+    """Physical byte offset of the first extent of `path` via FIEMAP, or None where
+    the platform or filesystem does not support it.
+    """
+    if fcntl is None:
+        return None
+    buf = bytearray(_FIEMAP_HEADER.size + _FIEMAP_EXTENT.size)
+    _FIEMAP_HEADER.pack_into(buf, 0, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+    try:
+        with open(path, 'rb') as f:
+            fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, buf)
+    except OSError:
+        return None
+    if not _FIEMAP_HEADER.unpack_from(buf)[3]:
+        return None
+    return _FIEMAP_EXTENT.unpack_from(buf, _FIEMAP_HEADER.size)[1]
+
+
+def io_order_key(rec, order):
+    """Sort key for pending reads on one device: inode number approximates on-disk
+    placement on most filesystems, FIEMAP gives the real physical offset.
+    """
+    if order == 'physical':
+        offset = physical_offset(rec.path)
+        if offset is not None:
+            return (offset, rec.ino)
+        return (float('inf'), rec.ino)
+    if order == 'inode':
+        return (rec.ino,)
+    return ()
+
+
+class DeviceScheduler:
+    """One hashing pool per device (st_dev), each sized independently.
+
+    Spinning disks want one or two readers each, SSDs and network mounts want
+    many. Separate pools keep one slow disk from starving the others and let
+    throughput grow with the number of devices.
+    """
+
+    def __init__(self, workers=1, kind='thread', device_workers=None):
+        self.workers = workers
+        self.kind = kind
+        self.device_workers = device_workers or {}
+        self.pools = {}
+
+    def workers_for(self, dev):
+        return self.device_workers.get(dev, self.workers)
+
+    def capacity(self, dev):
+        """Tasks to keep in flight on `dev`: enough to keep its workers busy while
+        leaving the rest in our ordered queue rather than the pool's FIFO.
+        """
+        return self.workers_for(dev) * 2
+
+    def submit(self, dev, fn, *args):
+        pool = self.pools.get(dev)
+        if pool is None:
+            cls = ThreadPoolExecutor if self.kind == 'thread' else ProcessPoolExecutor
+            pool = self.pools[dev] = cls(max_workers=self.workers_for(dev))
+        return pool.submit(fn, *args)
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.shutdown(cancel_futures=True)
+
+
+def refine_groups(groups, stages=None, scheduler=None, max_pending=1024, cache=None, counters=None,
+                  io_order='inode', stats=None):
+    """Yield lists of FileRecords whose digests agree on every stage.
+
+    `groups` is an iterable of same-size candidate lists and is consumed lazily.
+    Pending reads are queued per device and ordered by `io_order` (see
+    io_order_key), later stages first so confirmed groups come out early; at
+    most `max_pending` tasks and finished groups are queued, in flight or
+    waiting to be yielded at any time. Each device's
+    work goes to its own pool in `scheduler`; with no scheduler, tasks run
+    inline in the calling thread. Cached digests are used without reading
+    anything, and new ones are written back from this thread. Every finished
+    task is passed to `stats` (a RunStats) when given.
+    """
+    if stages is None:
+        stages = build_stages()
+    if counters is None:
+        counters = Counter()
+    groups = iter(groups)
+    exhausted = False
+    queues = {}  # st_dev -> one heap of pending reads per stage
+    queued = 0
+    order = itertools.count()
+    inflight = {}
+    inflight_by_dev = Counter()
+    ready = []
+
+    def start(records, stage):
+        nonlocal queued
+        counters['groups inspected'] += 1
+        while not stages[stage].applies(records[0].size):
+            stage += 1
+        state = _GroupState(stage, len(records))
+        kind = stages[stage].key
+        for rec in records:
+            digest = cache.get(rec, kind) if cache else None
+            if cache and stats:
+                stats.cache_lookup(stages[stage], digest is not None)
+            if digest is not None:
+                counters['cache hits'] += 1
+                finish(state, rec, digest)
+            else:
+                if cache:
+                    counters['cache misses'] += 1
+                heaps = queues.get(rec.dev)
+                if heaps is None:
+                    heaps = queues[rec.dev] = [[] for _ in stages]
+                heapq.heappush(heaps[stage], (io_order_key(rec, io_order), next(order), state, rec))
+                queued += 1
+
+    def finish(state, rec, digest):
+        if digest is not None:
+            state.buckets.setdefault(digest, []).append(rec)
+        state.remaining -= 1
+        if state.remaining:
+            return
+        stage = stages[state.stage]
+        for bucket in state.buckets.values():
+            if len(bucket) < 2:
+                continue
+            if state.stage + 1 < len(stages) and not stage.covers(bucket[0].size):
+                start(bucket, state.stage + 1)
+            else:
+                ready.append(bucket)
+
+    def record(state, rec, result):
+        digest, elapsed, worker = result
+        if stats:
+            stats.task_done(stages[state.stage], rec, elapsed, worker, digest is not None)
+        if digest is None:
+            counters['errors'] += 1
+        else:
+            # one task per stage; a file counts as hashed once every byte of it was
+            counters['hash tasks'] += 1
+            if stages[state.stage].covers(rec.size):
+                counters['files hashed'] += 1
+            if cache:
+                cache.put(rec, stages[state.stage].key, digest)
+        finish(state, rec, digest)
+
+    def next_task(heaps):
+        for stage in reversed(range(len(stages))):
+            if heaps[stage]:
+                _, _, state, rec = heapq.heappop(heaps[stage])
+                return state, rec
+        return None
+
+    while True:
+        # groups answered entirely from the cache land in `ready`; count them
+        # too so a warm run streams its results instead of buffering them all
+        while not exhausted and queued + len(inflight) + len(ready) < max_pending:
+            try:
+                group = next(groups)
+            except StopIteration:
+                exhausted = True
+                break
+            start(group, 0)
+
+        for dev in list(queues):
+            heaps = queues[dev]
+            limit = scheduler.capacity(dev) if scheduler else 1
+            while inflight_by_dev[dev] < limit:
+                task = next_task(heaps)
+                if task is None:
+                    break
+                queued -= 1
+                state, rec = task
+                stage = stages[state.stage]
+                if scheduler is None:
+                    record(state, rec, hash_task(stage, rec.path, rec.size))
+                else:
+                    inflight[scheduler.submit(dev, hash_task, stage, rec.path, rec.size)] = (state, rec)
+                    inflight_by_dev[dev] += 1
+            if not any(heaps):
+                del queues[dev]
+
+        if ready:
+            yield from ready
+            ready.clear()
+
+        if inflight:
+            done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+            for fut in done:
+                state, rec = inflight.pop(fut)
+                inflight_by_dev[rec.dev] -= 1
+                try:
+                    result = fut.result()
+                except Exception as e:
+                    logging.error(f"Error computing {stages[state.stage].name} hash for {rec.path}: {e}")
+                    result = (None, 0.0, None)
+                record(state, rec, result)
+        elif exhausted and not queued:
+            break
+
+
+def collapse_inodes(files):
+    """Split a same-size group into one record per (st_dev, st_ino) plus the aliases.
+
+    Returns (unique, aliases) where `unique` keeps the first path (in sorted order)
+    of every inode and `aliases` maps that record to the other paths of the same
+    inode: hard links, or the same file reached again through a followed symlink.
+    """
+    by_inode = {}
+    for rec in sorted(files, key=lambda r: r.path):
+        by_inode.setdefault((rec.dev, rec.ino), []).append(rec)
+    unique = []
+    aliases = {}
+    for recs in by_inode.values():
+        unique.append(recs[0])
+        if len(recs) > 1:
+            aliases[recs[0]] = recs[1:]
+    return unique, aliases
+
+
+class SizeIndex:
+    """Scanned files grouped by size.
+
+    Up to `max_files` records are kept in memory. Past that they are spilled to a
+    private temporary SQLite database (SQLite picks the directory, see
+    SQLITE_TMPDIR) and read back one size group at a time, so memory stays flat
+    however large the tree is.
+    """
+
+    def __init__(self, max_files=None):
+        self.max_files = max_files
+        self.by_size = {}
+        self.in_memory = 0
+        self.db = None
+
+    def add(self, rec):
+        self.by_size.setdefault(rec.size, []).append(rec)
+        self.in_memory += 1
+        if self.max_files and self.in_memory >= self.max_files:
+            self._spill()
+
+    def _spill(self):
+        if self.db is None:
+            # an empty name gives a temporary on-disk database, removed on close
+            self.db = sqlite3.connect("")
+            self.db.execute("PRAGMA journal_mode=OFF")
+            self.db.execute("PRAGMA synchronous=OFF")
+            self.db.execute(
+                "CREATE TABLE files (size INTEGER, dir TEXT, name TEXT, mtime_ns INTEGER,"
+                " dev INTEGER, ino INTEGER, nlink INTEGER)"
+            )
+            logging.debug(f"Size index over {self.max_files} files, spilling to disk")
+        self.db.executemany(
+            "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((r.size, r.dir, r.name, r.mtime_ns, r.dev, r.ino, r.nlink)
+             for recs in self.by_size.values() for r in recs),
+        )
+        self.db.commit()
+        self.by_size.clear()
+        self.in_memory = 0
+
+    def records(self):
+        """Yield every record, in size order once spilled."""
+        if self.db is None:
+            for files in self.by_size.values():
+                yield from files
+            return
+        self._spill()
+        for row in self.db.execute("SELECT dir, name, size, mtime_ns, dev, ino, nlink FROM files ORDER BY size"):
+            yield FileRecord(*row)
+
+    def groups(self):
+        """Yield lists of records that share a size with at least one other file."""
+        if self.db is None:
+            for files in self.by_size.values():
+                if len(files) > 1:
+                    yield files
+            return
+        self._spill()
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_size ON files (size)")
+        rows = self.db.execute(
+            "SELECT size, dir, name, mtime_ns, dev, ino, nlink FROM files"
+            " WHERE size IN (SELECT size FROM files GROUP BY size HAVING COUNT(*) > 1)"
+            " ORDER BY size"
+        )
+        dirs = {}
+        group = []
+        for size, dir, name, mtime_ns, dev, ino, nlink in rows:
+            if group and group[0].size != size:
+                yield group
+                group = []
+            dir = dirs.setdefault(dir, dir)
+            group.append(FileRecord(dir, name, size, mtime_ns, dev, ino, nlink))
+            if len(dirs) > 65536:
+                dirs.clear()
+        if group:
+            yield group
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+def report_groups(groups, reporter, stages, scheduler=None, max_pending=1024, cache=None, counters=None,
+                  io_order='inode', stats=None, reported=None):
+    """Collapse hard links in each same-size group, hash what is left, and report
+    every confirmed duplicate against the oldest copy. Returns the number of
+    duplicates reported. Each pair is also recorded in `reported` when given
+    (see report_changes).
+    """
+    if counters is None:
+        counters = Counter()
+
+    def candidates():
+        # hash every inode once; other names of it are reported as hardlinks
+        for files in groups:
+            unique, aliases = collapse_inodes(files)
+            for target, recs in aliases.items():
+                for rec in recs:
+                    if rec.nlink < 2:
+                        # only reachable again through a followed symlink
+                        logging.debug(f"Skipping {rec.path} (same file as {target.path})")
+                        continue
+                    counters['hardlinks'] += 1
+                    reporter.hardlink(rec.path, target.path)
+                    if reported is not None:
+                        reported[rec.path] = target.path
+            if len(unique) > 1:
+                yield unique
+
+    found = 0
+    for group in refine_groups(candidates(), stages, scheduler=scheduler, max_pending=max_pending,
+                               cache=cache, counters=counters, io_order=io_order, stats=stats):
+        # oldest copy is the original; ties keep path order
+        group.sort(key=lambda r: (r.mtime_ns, r.path))
+        original = group[0]
+        for rec in group[1:]:
+            reporter.duplicate(rec.path, original.path)
+            if reported is not None:
+                reported[(rec.dev, rec.ino)] = (original.dev, original.ino)
+            found += 1
+            counters['duplicates'] += 1
+    return found
+
+
+class DuplicateIndex:
+    """Every scanned file by path and by size, kept current by --watch.
+
+    Digests live in the hash index, so regrouping a size after a change only
+    reads the files that changed.
+    """
+
+    def __init__(self):
+        self.by_path = {}
+        self.by_size = {}
+
+    def add(self, rec):
+        self.remove(rec.path)
+        self.by_path[rec.path] = rec
+        self.by_size.setdefault(rec.size, {})[rec.path] = rec
+
+    def remove(self, path):
+        rec = self.by_path.pop(path, None)
+        if rec is not None:
+            same_size = self.by_size[rec.size]
+            del same_size[path]
+            if not same_size:
+                del self.by_size[rec.size]
+        return rec
+
+    def remove_tree(self, path):
+        prefix = os.path.join(path, '')
+        for p in [p for p in self.by_path if p.startswith(prefix)]:
+            self.remove(p)
+
+    def group(self, size):
+        return list(self.by_size.get(size, {}).values())
+
+    def groups(self):
+        for same_size in self.by_size.values():
+            if len(same_size) > 1:
+                yield list(same_size.values())
+
+    def close(self):
+        pass
+
+
+class Inotify:
+    """Minimal inotify(7) binding over ctypes. Linux only; raises OSError elsewhere."""
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+                  | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    _EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name or not sys.platform.startswith('linux'):
+            raise OSError("inotify is only available on Linux")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1: {os.strerror(err)}")
+        self.paths = {}  # watch descriptor -> directory path
+        self.wds = {}    # directory path -> watch descriptor
+
+    def add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            hint = " (raise fs.inotify.max_user_watches)" if err == errno.ENOSPC else ""
+            logging.error(f"Cannot watch {path}: {os.strerror(err)}{hint}")
+            return
+        self.paths[wd] = path
+        self.wds[path] = wd
+
+    def forget_tree(self, path):
+        """Stop watching `path` and everything below it, e.g. after it was moved away."""
+        prefix = os.path.join(path, '')
+        for p in [p for p in self.wds if p == path or p.startswith(prefix)]:
+            wd = self.wds.pop(p)
+            if self.paths.get(wd) == p:
+                del self.paths[wd]
+                self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """Wait up to `timeout` seconds and return a list of (directory, name, mask)."""
+        try:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+        except InterruptedError:
+            return []
+        if not ready:
+            return []
+        data = os.read(self.fd, 1 << 16)
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = self._EVENT.unpack_from(data, pos)
+            pos += self._EVENT.size
+            name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            if mask & self.IN_IGNORED:
+                path = self.paths.pop(wd, None)
+                if path is not None and self.wds.get(path) == wd:
+                    del self.wds[path]
+                continue
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((None, '', mask))
+            elif wd in self.paths:
+                events.append((self.paths[wd], name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def report_changes(index, changed, reporter, stages, scheduler=None, cache=None, counters=None, reported=None):
+    """Regroup the sizes touched by `changed` records and report only the new
+    duplicates and hard links among them.
+
+    `reported` maps what was already reported (a duplicate's inode, a hard
+    link's path) to its original and is updated in place, so rewriting a known
+    duplicate or linking its original under another name reports nothing again.
+    """
+    if reported is None:
+        reported = {}
+    changed_paths = {rec.path for rec in changed}
+    current = set()
+    for size in {rec.size for rec in changed}:
+        group = index.group(size)
+        if len(group) < 2:
+            continue
+        unique, aliases = collapse_inodes(group)
+        for target, recs in aliases.items():
+            for rec in recs:
+                # the older record's st_nlink predates the new link
+                if (rec.nlink > 1 or target.nlink > 1) and (rec.path in changed_paths
+                                                            or target.path in changed_paths):
+                    current.add(rec.path)
+                    if reported.get(rec.path) != target.path:
+                        reported[rec.path] = target.path
+                        counters['hardlinks'] += 1
+                        reporter.hardlink(rec.path, target.path)
+        if len(unique) < 2:
+            continue
+        for confirmed in refine_groups([unique], stages, scheduler=scheduler, cache=cache, counters=counters):
+            confirmed.sort(key=lambda r: (r.mtime_ns, r.path))
+            original = confirmed[0]
+            for rec in confirmed[1:]:
+                # a changed original (say, copied in with an older mtime) re-bases the whole group
+                if rec.path in changed_paths or original.path in changed_paths:
+                    key = (rec.dev, rec.ino)
+                    current.add(key)
+                    if reported.get(key) != (original.dev, original.ino):
+                        reported[key] = (original.dev, original.ino)
+                        reporter.duplicate(rec.path, original.path)
+                        counters['duplicates'] += 1
+    # forget pairs a change undid, so they are reported again if they come back
+    for key in changed_paths | {(rec.dev, rec.ino) for rec in changed}:
+        if key not in current:
+            reported.pop(key, None)
+
+
+def watch_tree(roots, index, inotify, reporter, stages, path_filter=None, scheduler=None, cache=None,
+               counters=None, follow_symlinks=False, interval=1.0, reported=None):
+    """Keep `index` current from inotify events and report new duplicates as they appear.
+    `reported` holds the pairs the initial report already printed.
+
+    SIGUSR1 writes the full current duplicate report. Returns on KeyboardInterrupt
+    or SIGTERM.
+    """
+    if counters is None:
+        counters = Counter()
+    dump_requested = False
+
+    def request_dump(signum, frame):
+        nonlocal dump_requested
+        dump_requested = True
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, request_dump)
+    signal.signal(signal.SIGTERM, stop)
+
+    if path_filter is None:
+        path_filter = PathFilter()
+    if reported is None:
+        reported = {}
+
+    def root_of(path):
+        """The watched root `path` is in; the innermost one if roots nest."""
+        found = None
+        for root in roots:
+            root = os.path.normpath(root)
+            if (path == root or path.startswith(os.path.join(root, ''))) and (found is None
+                                                                             or len(root) > len(found)):
+                found = root
+        return found
+
+    def rescan(path):
+        added = []
+        if path not in roots and not path_filter.accept_dir(path, root_of(path)):
+            return added
+        for rec in scan_tree([path], follow_symlinks=follow_symlinks, on_dir=inotify.add_watch,
+                             counters=counters, path_filter=path_filter):
+            index.add(rec)
+            added.append(rec)
+        return added
+
+    logging.debug(f"Watching {len(inotify.wds)} directories")
+    try:
+        while True:
+            events = inotify.read(interval)
+            changed = {}
+            for dirpath, name, mask in events:
+                if dirpath is None:
+                    logging.warning("inotify queue overflowed, rescanning")
+                    for root in roots:
+                        index.remove_tree(root)
+                        for rec in rescan(root):
+                            changed[rec.path] = rec
+                    continue
+                path = os.path.join(dirpath, name) if name else dirpath
+                if mask & (Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF):
+                    if path in roots:
+                        logging.warning(f"{path} was removed or moved, no longer watching it")
+                    continue
+                if mask & Inotify.IN_ISDIR:
+                    if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                        for rec in rescan(path):
+                            changed[rec.path] = rec
+                    elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                        index.remove_tree(path)
+                        inotify.forget_tree(path)
+                    continue
+                if mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                    index.remove(path)
+                    changed.pop(path, None)
+                    reported.pop(path, None)
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    index.remove(path)
+                    changed.pop(path, None)
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                if mask & Inotify.IN_CREATE and st.st_nlink < 2 and not os.path.islink(path):
+                    # still being written (or a preallocated placeholder of its final
+                    # size): wait for IN_CLOSE_WRITE. Only a new hard link is complete.
+                    continue
+                rec = FileRecord.from_stat(dirpath, name, st)
+                if path_filter.accept(rec, root_of(dirpath)):
+                    index.add(rec)
+                    changed[path] = rec
+                else:
+                    index.remove(path)
+
+            if changed:
+                report_changes(index, changed.values(), reporter, stages, scheduler=scheduler,
+                               cache=cache, counters=counters, reported=reported)
+            if dump_requested:
+                dump_requested = False
+                report_groups(index.groups(), reporter, stages, scheduler=scheduler, cache=cache, counters=counters,
+                              reported=reported)
+            if changed or events:
+                reporter.out.flush()
+                if cache:
+                    cache.commit()
+    except KeyboardInterrupt:
+        pass
+
+
+def digest_records(records, stage, scheduler=None, max_pending=1024, cache=None, counters=None, stats=None):
+    """Yield (record, digest) for every record, digest None when it cannot be read.
+
+    Unlike refine_groups this hashes every file, grouped or not; it is what the
+    manifest needs, since a size that is unique here may collide on another host.
+    """
+    if counters is None:
+        counters = Counter()
+    inflight = {}
+
+    def result(rec, res):
+        digest, elapsed, worker = res
+        if stats:
+            stats.task_done(stage, rec, elapsed, worker, digest is not None)
+        if digest is None:
+            counters['errors'] += 1
+        else:
+            counters['hash tasks'] += 1
+            if stage.covers(rec.size):
+                counters['files hashed'] += 1
+            if cache:
+                cache.put(rec, stage.key, digest)
+        return rec, digest
+
+    def drain(block):
+        done, _ = wait(inflight, return_when=FIRST_COMPLETED) if block else (list(inflight), None)
+        for fut in done:
+            rec = inflight.pop(fut)
+            try:
+                res = fut.result()
+            except Exception as e:
+                logging.error(f"Error computing {stage.name} hash for {rec.path}: {e}")
+                res = (None, 0.0, None)
+            yield result(rec, res)
+
+    for rec in records:
+        digest = cache.get(rec, stage.key) if cache else None
+        if cache and stats:
+            stats.cache_lookup(stage, digest is not None)
+        if digest is not None:
+            counters['cache hits'] += 1
+            yield rec, digest
+            continue
+        if cache:
+            counters['cache misses'] += 1
+        if scheduler is None:
+            yield result(rec, hash_task(stage, rec.path, rec.size))
+            continue
+        inflight[scheduler.submit(rec.dev, hash_task, stage, rec.path, rec.size)] = rec
+        if len(inflight) >= max_pending:
+            yield from drain(True)
+    while inflight:
+        wait(inflight)
+        yield from drain(False)
+
+
+# Manifest file: MANIFEST_MAGIC, a u32 length and that many bytes of JSON
+# metadata, then `count` records sorted by (size, partial digest, path). Each
+# record is _MANIFEST_RECORD followed by the partial digest (partial_len
+# bytes), the full digest (full_len bytes, only when has_full is set) and the
+# UTF-8/surrogateescape encoded absolute path.
+MANIFEST_MAGIC = b'FDMANIF1'
+MANIFEST_PARTIAL_LEN = 16
+_MANIFEST_LEN = struct.Struct('<I')
+_MANIFEST_RECORD = struct.Struct('<QqBH')  # size, mtime_ns, has_full, path length
+
+
+class ManifestEntry:
+    __slots__ = ('size', 'partial', 'mtime_ns', 'full', 'path', 'host')
+
+    def __init__(self, size, partial, mtime_ns, full, path, host):
+        self.size = size
+        self.partial = partial
+        self.mtime_ns = mtime_ns
+        self.full = full
+        self.path = path
+        self.host = host
+
+    @property
+    def name(self):
+        return f"{self.host}:{self.path}"
+
+
+def write_manifest(path, entries, host, algo):
+    """Write ManifestEntry objects (any order) to `path`, atomically."""
+    entries = sorted(entries, key=lambda e: (e.size, e.partial, e.path))
+    full_len = len(new_hasher(algo).digest())
+    # build_manifest truncates to MANIFEST_PARTIAL_LEN; 64-bit hashes are shorter
+    partial_len = min(full_len, MANIFEST_PARTIAL_LEN)
+    meta = {
+        'host': host,
+        'algo': algo,
+        'partial': 'headtail',
+        'partial_len': partial_len,
+        'full_len': full_len,
+        'head_bytes': HEAD_BYTES,
+        'tail_bytes': TAIL_BYTES,
+        'count': len(entries),
+    }
+    blob = json.dumps(meta).encode('utf-8')
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, 'wb') as f:
+        f.write(MANIFEST_MAGIC + _MANIFEST_LEN.pack(len(blob)) + blob)
+        for e in entries:
+            name = os.fsencode(e.path)
+            f.write(_MANIFEST_RECORD.pack(e.size, e.mtime_ns, e.full is not None, len(name)))
+            f.write(e.partial)
+            if e.full is not None:
+                f.write(e.full)
+            f.write(name)
+    os.replace(tmp, path)
+    return meta
+
+
+def read_manifest_meta(f):
+    if f.read(len(MANIFEST_MAGIC)) != MANIFEST_MAGIC:
+        raise ValueError(f"{f.name} is not a find_dupes manifest")
+    (length,) = _MANIFEST_LEN.unpack(f.read(_MANIFEST_LEN.size))
+    return json.loads(f.read(length))
+
+
+def read_manifest(path):
+    """Yield the ManifestEntry records of one manifest, in file (sorted) order."""
+    with open(path, 'rb', buffering=1 << 20) as f:
+        meta = read_manifest_meta(f)
+        host = meta['host']
+        plen = meta['partial_len']
+        flen = meta['full_len']
+        read = f.read
+        unpack = _MANIFEST_RECORD.unpack
+        rsize = _MANIFEST_RECORD.size
+        for _ in range(meta['count']):
+            size, mtime_ns, has_full, path_len = unpack(read(rsize))
+            partial = read(plen)
+            full = read(flen) if has_full else None
+            yield ManifestEntry(size, partial, mtime_ns, full, os.fsdecode(read(path_len)), host)
+
+
+def build_manifest(records, algo, host, scheduler=None, max_pending=1024, cache=None, counters=None,
+                   stats=None, full_for=(), drop_cache=False):
+    """Hash the head+tail of every record and return ManifestEntry objects.
+
+    Full digests are included when the hash index already has them, and are
+    computed for the absolute paths in `full_for` (requested by a merge).
+    """
+    partial_stage = Stage('headtail', algo)
+    full_stage = Stage('full', algo, drop_cache)
+    full_for = set(full_for)
+    entries = []
+    need_full = []
+    seen = set()
+    unique = []
+    for rec in records:
+        # one entry per inode: extra hard links are not duplicates of anything
+        if (rec.dev, rec.ino) not in seen:
+            seen.add((rec.dev, rec.ino))
+            unique.append(rec)
+    for rec, partial in digest_records(unique, partial_stage, scheduler=scheduler, max_pending=max_pending,
+                                       cache=cache, counters=counters, stats=stats):
+        if partial is None:
+            continue
+        path = os.path.abspath(rec.path)
+        full = cache.get(rec, full_stage.key) if cache else None
+        entry = ManifestEntry(rec.size, bytes.fromhex(partial)[:MANIFEST_PARTIAL_LEN], rec.mtime_ns,
+                              bytes.fromhex(full) if full else None, path, host)
+        entries.append(entry)
+        if full is None and path in full_for:
+            need_full.append((rec, entry))
+    by_rec = {id(rec): entry for rec, entry in need_full}
+    for rec, full in digest_records([rec for rec, _ in need_full], full_stage, scheduler=scheduler,
+                                    max_pending=max_pending, cache=cache, counters=counters, stats=stats):
+        if full is not None:
+            by_rec[id(rec)].full = bytes.fromhex(full)
+    return entries
+
+
+def merge_manifests(paths, reporter, requests_dir=None, counters=None):
+    """Join per-host manifests and report duplicates that span hosts.
+
+    The manifests are merged as sorted streams, so memory holds one candidate
+    group at a time. Groups are keyed by size and partial digest. A group is
+    only a candidate when its members come from more than one host, and only
+    members on a different host than the group's original are reported,
+    because duplicates within one host are found by a normal run. A candidate is
+    confirmed by full digests. Members without one are listed, per owning
+    host, in `requests_dir`/<host>.jsonl. Feed that file back with
+    --full-hash-list when that host rewrites its manifest.
+    """
+    if counters is None:
+        counters = Counter()
+    metas = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            metas.append(read_manifest_meta(f))
+    if len({(m['algo'], m['partial_len'], m['head_bytes'], m['tail_bytes']) for m in metas}) > 1:
+        raise ValueError("manifests were written with different --hash-algo or head/tail sizes")
+    conclusive_size = metas[0]['head_bytes'] + metas[0]['tail_bytes'] if metas else 0
+
+    requests = {}
+    try:
+        key = lambda e: (e.size, e.partial)
+        for _, members in itertools.groupby(heapq.merge(*(read_manifest(p) for p in paths), key=key), key=key):
+            members = list(members)
+            counters['manifest entries'] += len(members)
+            if len(members) < 2 or len({m.host for m in members}) < 2:
+                continue
+            counters['candidate groups'] += 1
+            if members[0].size <= conclusive_size:
+                # head+tail already covered the whole file
+                confirmed = [members]
+            else:
+                missing = [m for m in members if m.full is None]
+                if missing:
+                    counters['full hashes requested'] += len(missing)
+                    if requests_dir:
+                        for m in missing:
+                            out = requests.get(m.host)
+                            if out is None:
+                                out = requests[m.host] = open(os.path.join(requests_dir, f"{m.host}.jsonl"),
+                                                              'w', encoding='utf-8')
+                            out.write(json.dumps({'path': m.path, 'size': m.size}, ensure_ascii=False) + "\n")
+                    continue
+                by_full = {}
+                for m in members:
+                    by_full.setdefault(m.full, []).append(m)
+                confirmed = list(by_full.values())
+            for group in confirmed:
+                if len(group) < 2:
+                    continue
+                group.sort(key=lambda m: (m.mtime_ns, m.host, m.path))
+                original = group[0]
+                for m in group[1:]:
+                    if m.host == original.host:
+                        # same-host copies are left to a normal run on that host
+                        continue
+                    reporter.duplicate(m.name, original.name)
+                    counters['duplicates'] += 1
+    finally:
+        for out in requests.values():
+            out.close()
+    if counters['full hashes requested'] and not requests_dir:
+        logging.warning(f"{counters['full hashes requested']} candidates need full hashes; "
+                        "rerun with --requests-dir to list them per host")
+    return counters
+
+
+def read_full_hash_list(path):
+    """Absolute paths from a <host>.jsonl request file written by --merge-manifests."""
+    with open(path, encoding='utf-8') as f:
+        return {json.loads(line)['path'] for line in f if line.strip()}
+
+
+class RunStats:
+    """Timing and I/O accounting for one run, for --stats-json and --progress.
+
+    Phases record wall and CPU time of this process (CPU covers all of its
+    threads). Hash stages record tasks, bytes read, worker busy time and index
+    hits; workers record their own throughput; the slowest reads are kept.
+    """
+
+    def __init__(self, stages=(), progress=None, slowest=10, progress_interval=0.5):
+        self.counters = Counter()
+        self.phases = {}
+        self.stages = {stage.name: Counter() for stage in stages}
+        self.workers = {}
+        self.slowest = []
+        self.slowest_count = slowest
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.current_phase = None
+        self._start = time.perf_counter()
+        self._last_progress = 0.0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        previous = self.current_phase
+        self.current_phase = name
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            totals = self.phases.setdefault(name, Counter())
+            totals['wall_s'] += time.perf_counter() - wall
+            totals['cpu_s'] += time.process_time() - cpu
+            self.current_phase = previous
+
+    def cache_lookup(self, stage, hit):
+        self.stages.setdefault(stage.name, Counter())['cache_hits' if hit else 'cache_misses'] += 1
+
+    def task_done(self, stage, rec, elapsed, worker, ok):
+        nbytes = stage.read_bytes(rec.size) if ok else 0
+        totals = self.stages.setdefault(stage.name, Counter())
+        totals['tasks'] += 1
+        totals['bytes_read'] += nbytes
+        totals['busy_s'] += elapsed
+        if not ok:
+            totals['errors'] += 1
+        if worker is not None:
+            w = self.workers.setdefault(worker, Counter())
+            w['tasks'] += 1
+            w['bytes_read'] += nbytes
+            w['busy_s'] += elapsed
+        item = (elapsed, rec.path, stage.name, rec.size)
+        if len(self.slowest) < self.slowest_count:
+            heapq.heappush(self.slowest, item)
+        elif self.slowest and item > self.slowest[0]:
+            heapq.heapreplace(self.slowest, item)
+        self.tick()
+
+    def bytes_read(self):
+        return sum(totals['bytes_read'] for totals in self.stages.values())
+
+    def tick(self, force=False):
+        """Redraw the progress line, at most every progress_interval seconds."""
+        if not self.progress:
+            return
+        now = time.perf_counter()
+        if not force and now - self._last_progress < self.progress_interval:
+            return
+        self._last_progress = now
+        elapsed = max(now - self._start, 1e-9)
+        mib = self.bytes_read() / (1024 * 1024)
+        line = (f"{self.current_phase or 'done'}: {self.counters['files scanned']} files scanned, "
+                f"{self.counters['files hashed']} hashed, {mib:.1f} MiB read ({mib / elapsed:.1f} MiB/s), "
+                f"{self.counters['duplicates']} duplicates")
+        self.progress.write(f"\r\033[K{line}")
+        self.progress.flush()
+
+    def end_progress(self):
+        if self.progress:
+            self.tick(force=True)
+            self.progress.write("\n")
+            self.progress.flush()
+
+    def to_dict(self):
+        def rounded(counter):
+            return {k: round(v, 6) if isinstance(v, float) else v for k, v in counter.items()}
+
+        stages = {}
+        for name, totals in self.stages.items():
+            entry = rounded(totals)
+            lookups = totals['cache_hits'] + totals['cache_misses']
+            entry['cache_hit_ratio'] = round(totals['cache_hits'] / lookups, 4) if lookups else None
+            stages[name] = entry
+        workers = {}
+        for name, totals in self.workers.items():
+            entry = rounded(totals)
+            busy = totals['busy_s']
+            entry['bytes_per_s'] = round(totals['bytes_read'] / busy, 1) if busy else None
+            workers[name] = entry
+        children = os.times()
+        return {
+            'wall_s': round(time.perf_counter() - self._start, 6),
+            'cpu_s': round(time.process_time(), 6),
+            'child_cpu_s': round(children.children_user + children.children_system, 6),
+            'counters': dict(self.counters),
+            'bytes_read': self.bytes_read(),
+            'phases': {name: rounded(totals) for name, totals in self.phases.items()},
+            'stages': stages,
+            'workers': workers,
+            'slowest_files': [
+                {'path': path, 'stage': stage, 'size': size, 'seconds': round(elapsed, 6)}
+                for elapsed, path, stage, size in sorted(self.slowest, reverse=True)
+            ],
+        }
+
+
+class Reporter:
+    """Writes results in the selected format as soon as they are confirmed.
+
+    JSON output is streamed one array element at a time instead of being
+    collected and dumped at the end.
+    """
+
+    def __init__(self, out, fmt='text', oneline=False, hardlinks=True, stats=None):
+        self.out = out
+        self.fmt = fmt
+        self.oneline = oneline
+        self.hardlinks = hardlinks
+        self.stats = stats
+        self._items = 0
+
+    def _phase(self):
+        return self.stats.phase('output') if self.stats else contextlib.nullcontext()
+
+    def _emit(self, obj):
+        if self.fmt == 'jsonl':
+            self.out.write(json.dumps(obj, ensure_ascii=False) + "\n")
+            return
+        text = json.dumps(obj, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+        self.out.write(("[\n  " if not self._items else ",\n  ") + text)
+        self._items += 1
+
+    def duplicate(self, newer, older):
+        """Report that `newer` duplicates `older`."""
+        with self._phase():
+            if self.fmt == 'text':
+                if self.oneline:
+                    print(newer, file=self.out)
+                else:
+                    print(f"{newer} ; duplicate of {older}", file=self.out)
+            else:
+                self._emit({'newer': newer, 'older': older})
+
+    def hardlink(self, path, target):
+        """Report that `path` is another name for the same inode as `target`."""
+        if not self.hardlinks:
+            return
+        with self._phase():
+            if self.fmt == 'text':
+                if not self.oneline:
+                    print(f"{path} ; hardlink of {target}", file=self.out)
+            else:
+                self._emit({'hardlink': path, 'of': target})
+
+    def close(self):
+        """Finish the JSON array, if any."""
+        if self.fmt == 'json':
+            self.out.write("\n]" if self._items else "[]")
+            if self.out is not sys.stdout:
+                self.out.write("\n")
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -67,230 +1641,268 @@ def main():
     parser.add_argument("-1", action="store_true", dest="oneline",
                         help="Only print the duplicate file path")
     parser.add_argument("-w", "--workers", type=int, default=1,
-                        help="Number of worker processes/threads to use (reserved, currently single-threaded)")
+                        help="Number of hashing workers per device (default: 1, hash inline)")
+    parser.add_argument("--device-workers", action="append", default=[], metavar="PATH=N",
+                        help="Use N hashing workers for the device holding PATH, e.g. 1 for a spinning disk "
+                             "and 8 for an SSD (can be repeated)")
+    parser.add_argument("--executor", choices=("thread", "process"), default="thread",
+                        help="Hashing worker type (default: thread; hashlib releases the GIL)")
+    parser.add_argument("--io-order", choices=("inode", "physical", "none"), default="inode",
+                        help="Order reads on each device by inode number (default), by physical offset "
+                             "from FIEMAP (one extra ioctl per file), or not at all")
+    parser.add_argument("--queue-size", type=int, default=1024,
+                        help="Maximum hash tasks queued or in flight; larger gives the read ordering "
+                             "more to work with (default: 1024)")
     parser.add_argument("--min-size", type=int, default=1,
                         help="Skip files smaller than this many bytes (default: 1)")
+    parser.add_argument("--max-size", type=int, default=None,
+                        help="Skip files larger than this many bytes")
+    parser.add_argument("--newer-than", type=parse_time, default=None, metavar="WHEN",
+                        help="Only files modified after WHEN: an age like 12h, 7d, 2w or an ISO date")
+    parser.add_argument("--older-than", type=parse_time, default=None, metavar="WHEN",
+                        help="Only files modified before WHEN: an age like 12h, 7d, 2w or an ISO date")
     parser.add_argument("-e", "--exclude", action="append", default=[],
-                        help="Glob pattern to exclude (can be repeated). Patterns are matched against full path.")
+                        help="Glob pattern to exclude (can be repeated). Patterns are matched against full path; "
+                             "a pattern ending in '/' matches directories ('node_modules/', '*/cache/'), "
+                             "which are skipped without being read.")
+    parser.add_argument("-i", "--include", action="append", default=[],
+                        help="Only consider files whose full path matches this glob pattern (can be repeated)")
     parser.add_argument("-o", "--output-file", default=None,
                         help="Write output to this file instead of stdout")
     parser.add_argument("--follow-symlinks", action="store_true",
                         help="Follow symbolic links when walking directories")
+    parser.add_argument("--scan-threads", type=int, default=4,
+                        help="Number of threads listing directories concurrently (default: 4)")
+    parser.add_argument("--memory-files", type=int, default=None, metavar="N",
+                        help="Keep at most N file records in memory; beyond that the size index spills "
+                             "to a temporary database (default: unlimited)")
+    parser.add_argument("--watch", action="store_true",
+                        help="After the initial report keep running: follow changes with inotify and report new "
+                             "duplicates as they appear; SIGUSR1 prints the full current report (Linux only)")
+    parser.add_argument("--write-manifest", default=None, metavar="FILE",
+                        help="Instead of reporting, write a binary manifest of every file (size, head+tail digest, "
+                             "full digest when known, path, mtime) for --merge-manifests on another machine")
+    parser.add_argument("--host", default=socket.gethostname(),
+                        help="Host name recorded in the manifest (default: this machine's host name)")
+    parser.add_argument("--full-hash-list", action="append", default=[], metavar="FILE",
+                        help="With --write-manifest: also store full digests for the paths a merge requested "
+                             "in FILE (<host>.jsonl from --requests-dir; can be repeated)")
+    parser.add_argument("--merge-manifests", nargs="+", default=None, metavar="MANIFEST",
+                        help="Join manifests from several hosts and report duplicates that span hosts; "
+                             "no directories are scanned")
+    parser.add_argument("--requests-dir", default=None, metavar="DIR",
+                        help="With --merge-manifests: write <host>.jsonl lists of files whose full digest is "
+                             "needed to confirm a cross-host candidate")
     parser.add_argument("-v", "--verbose", action="store_true",
                         help="Verbose messages to stderr")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="Only warnings and errors on stderr; no summary")
+    parser.add_argument("--progress", action="store_true",
+                        help="Show a live progress line on stderr")
+    parser.add_argument("--stats-json", default=None, metavar="FILE",
+                        help="Write per-phase timing, bytes read, cache hit ratios, per-worker throughput and "
+                             "the slowest files as JSON to FILE ('-' for stderr)")
     parser.add_argument("--format", choices=("text", "json", "jsonl"), default="text",
                         help="Output format: 'text' (default), 'json' (array), or 'jsonl' (one JSON object per line)")
     parser.add_argument("--cache-file", default=None,
-                        help="Path to JSON cache file to read/write partial results (stores size, mtime, hash)")
+                        help="Path to SQLite hash index, updated as files are hashed (keyed by device, inode, size, mtime)")
+    parser.add_argument("--stages", default=",".join(DEFAULT_STAGES),
+                        help="Comma-separated comparison stages, cheapest first, ending with 'full' "
+                             f"(choices: {', '.join(Stage.NAMES)}; default: {','.join(DEFAULT_STAGES)})")
+    parser.add_argument("--hash-algo", choices=sorted(HASH_ALGOS), default="blake2b",
+                        help="Digest used by every stage (default: blake2b; xxh* need the xxhash module)")
+    parser.add_argument("--hardlinks", choices=("report", "ignore"), default="report",
+                        help="Report extra names of an already seen inode as 'hardlink of' (default) or ignore them; "
+                             "either way each inode is hashed once and never reported as a duplicate of itself")
+    parser.add_argument("--keep-page-cache", action="store_true",
+                        help="Do not drop the pages of fully hashed files from the page cache")
     args = parser.parse_args()
+    device_workers = {}
+    for spec in args.device_workers:
+        path, sep, count = spec.rpartition("=")
+        try:
+            device_workers[os.stat(path).st_dev] = int(count)
+        except (OSError, ValueError) as e:
+            parser.error(f"--device-workers {spec}: {e}")
+    try:
+        stages = build_stages(args.stages.split(","), args.hash_algo, drop_cache=not args.keep_page_cache)
+    except ValueError as e:
+        parser.error(f"--stages: {e}")
+    inotify = None
+    if args.watch:
+        if args.format == 'json':
+            parser.error("--watch writes results as they appear; use --format text or jsonl")
+        if args.memory_files:
+            parser.error("--watch keeps every file in memory; --memory-files cannot be used with it")
+        if args.write_manifest or args.merge_manifests:
+            parser.error("--watch cannot be combined with manifests")
+        try:
+            inotify = Inotify()
+        except OSError as e:
+            parser.error(f"--watch: {e}")
+    if args.write_manifest and args.merge_manifests:
+        parser.error("--write-manifest and --merge-manifests are separate steps")
+    if args.merge_manifests and args.format == 'json':
+        parser.error("--merge-manifests writes results as they are found; use --format text or jsonl")
+    full_for = set()
+    for path in args.full_hash_list:
+        try:
+            full_for |= read_full_hash_list(path)
+        except (OSError, ValueError, KeyError) as e:
+            parser.error(f"--full-hash-list {path}: {e}")
 
-    # configure logging: verbose -> DEBUG, otherwise WARNING; send to stderr
-    log_level = logging.DEBUG if args.verbose else logging.WARNING
+    # configure logging: verbose -> DEBUG, quiet -> WARNING, otherwise INFO (the summary); send to stderr
+    log_level = logging.DEBUG if args.verbose else logging.WARNING if args.quiet else logging.INFO
     logging.basicConfig(level=log_level, format='%(levelname)s: %(message)s')
 
-    # First pass: group files by file size.
-    files_by_size = {}
+    if args.merge_manifests:
+        if args.requests_dir:
+            os.makedirs(args.requests_dir, exist_ok=True)
+        out = open(args.output_file, 'w', encoding='utf-8') if args.output_file else sys.stdout
+        reporter = Reporter(out, args.format, args.oneline)
+        try:
+            counters = merge_manifests(args.merge_manifests, reporter, requests_dir=args.requests_dir)
+        except (OSError, ValueError) as e:
+            logging.error(f"--merge-manifests: {e}")
+            return 1
+        finally:
+            reporter.close()
+            if out is not sys.stdout:
+                out.close()
+        logging.info("Summary:")
+        for key in ('manifest entries', 'candidate groups', 'full hashes requested', 'duplicates'):
+            logging.info(f" {key}: {counters[key]}")
+        return 0
+
+    stats = RunStats(stages, progress=sys.stderr if args.progress else None)
     # counters for final summary
-    files_scanned = 0
-    files_hashed = 0
-    cache_hits = 0
-    cache_misses = 0
-    groups_inspected = 0
-    duplicates_found = 0
-    errors_count = 0
-    skipped_count = 0
+    counters = stats.counters
+
+    path_filter = PathFilter(args.exclude, args.include, min_size=args.min_size, max_size=args.max_size,
+                             newer_than_ns=args.newer_than, older_than_ns=args.older_than)
+
+    # First pass: group files by file size.
+    files_by_size = DuplicateIndex() if args.watch else SizeIndex(args.memory_files)
+    # pairs already printed, so --watch reports only new ones
+    reported = {} if args.watch else None
+    roots = []
     for directory in args.directories:
         if not os.path.isdir(directory):
             print(f"Warning: {directory} is not a directory, skipping.", file=sys.stderr)
             continue
-        for filepath in find_files(directory, follow_symlinks=args.follow_symlinks):
-            if not os.path.isfile(filepath):
-                continue
-            # exclude patterns
-            if args.exclude and any(fnmatch.fnmatch(filepath, pat) for pat in args.exclude):
-                logging.debug(f"Excluding {filepath} (matched exclude pattern)")
-                skipped_count += 1
-                continue
-            try:
-                size = os.path.getsize(filepath)
-            except Exception as e:
-                logging.error(f"Error getting size for {filepath}: {e}")
-                continue
-            if size < args.min_size:
-                logging.debug(f"Skipping {filepath} (size {size} < min-size {args.min_size})")
-                skipped_count += 1
-                continue
-            files_by_size.setdefault(size, []).append(filepath)
-            files_scanned += 1
-
-    # Now process groups with more than one file.
-    master_files = {}  # mapping from file hash to (master_filepath, master_mtime)
-    # Load cache if requested
-    cache = {}
-    cache_enabled = bool(args.cache_file)
-    if cache_enabled and os.path.isfile(args.cache_file):
+        roots.append(directory)
+
+    with stats.phase('walk'):
+        for rec in scan_tree(roots, follow_symlinks=args.follow_symlinks, threads=args.scan_threads,
+                             on_dir=inotify.add_watch if inotify else None, counters=counters,
+                             path_filter=path_filter):
+            files_by_size.add(rec)
+            counters['files scanned'] += 1
+            stats.tick()
+
+    # Open the hash index if requested
+    cache = None
+    if args.cache_file:
         try:
-            with open(args.cache_file, 'r', encoding='utf-8') as cf:
-                cache = json.load(cf)
-        except Exception as e:
-            logging.warning(f"failed to read cache file {args.cache_file}: {e}")
+            cache = HashCache(args.cache_file)
+        except sqlite3.Error as e:
+            logging.warning(f"failed to open cache file {args.cache_file}: {e}")
+    if cache is None and args.watch:
+        # digests must outlive each regrouping; without a cache file keep them in memory
+        cache = HashCache(":memory:")
 
     # Prepare output stream
     out = None
+    reporter = None
     try:
         if args.output_file:
             out = open(args.output_file, 'w', encoding='utf-8')
         else:
             out = sys.stdout
+        reporter = Reporter(out, args.format, args.oneline, hardlinks=args.hardlinks == 'report', stats=stats)
 
-        # container for json array when using --format json
-        json_results = []
-
-        for size, files in files_by_size.items():
-            if len(files) < 2:
-                continue
-
-            # partial-hash prefilter
-            partial_map = {}
-            failed_partial = []
-            for fp in files:
-                ph = compute_partial_hash(fp)
-                if ph is None:
-                    failed_partial.append(fp)
-                else:
-                    partial_map.setdefault(ph, []).append(fp)
-
-            # groups to inspect further: those with same partial hash (len>1) and those that failed partial
-            groups = [g for g in partial_map.values() if len(g) > 1]
-            if failed_partial:
-                groups.append(failed_partial)
-
-            groups_inspected += len(groups)
-
-            for group in groups:
-                # determine which files need real hashing (not in cache or changed)
-                to_hash = []
-                hashes = {}
-                mtimes = {}
-                for fp in group:
-                    abs_path = os.path.abspath(fp)
-                    try:
-                        mtime = os.path.getmtime(fp)
-                    except Exception as e:
-                        logging.error(f"Error getting mtime for {fp}: {e}")
-                        mtime = None
-                    mtimes[fp] = mtime
-                    entry = cache.get(abs_path) if cache_enabled else None
-                    try:
-                        size_fp = os.path.getsize(fp)
-                    except Exception:
-                        size_fp = None
-                    if cache_enabled and entry and entry.get('size') == size_fp and entry.get('mtime') == mtime and entry.get('hash'):
-                        hashes[fp] = entry['hash']
-                        logging.debug(f"Using cached hash for {abs_path}")
-                        cache_hits += 1
-                    else:
-                        to_hash.append(fp)
-                        cache_misses += 1
-
-                # compute hashes for to_hash, possibly in parallel
-                if to_hash:
-                    if args.workers and args.workers > 1:
-                        with ProcessPoolExecutor(max_workers=args.workers) as ex:
-                            future_map = {ex.submit(compute_hash, fp): fp for fp in to_hash}
-                            for fut in as_completed(future_map):
-                                fp = future_map[fut]
-                                try:
-                                    h = fut.result()
-                                except Exception as e:
-                                    logging.error(f"Error computing hash for {fp}: {e}")
-                                    continue
-                                if h is None:
-                                    continue
-                                hashes[fp] = h
-                                if cache_enabled:
-                                    cache[os.path.abspath(fp)] = {'size': os.path.getsize(fp), 'mtime': mtimes.get(fp), 'hash': h}
-                                files_hashed += 1
-                    else:
-                        for fp in to_hash:
-                            h = compute_hash(fp)
-                            if h is None:
-                                continue
-                            hashes[fp] = h
-                            if cache_enabled:
-                                cache[os.path.abspath(fp)] = {'size': os.path.getsize(fp), 'mtime': mtimes.get(fp), 'hash': h}
-                            files_hashed += 1
-
-                # now process each file's hash against master_files
-                for fp, file_hash in hashes.items():
-                    mtime = mtimes.get(fp)
-                    if file_hash not in master_files:
-                        master_files[file_hash] = (fp, mtime)
-                        continue
-                    master_path, master_mtime = master_files[file_hash]
-                    if mtime is None:
-                        continue
-                    if mtime < master_mtime:
-                        result = {'newer': master_path, 'older': fp}
-                        if args.format == 'text':
-                            if args.oneline:
-                                print(master_path, file=out)
-                            else:
-                                print(f"{master_path} ; duplicate of {fp}", file=out)
-                        elif args.format == 'jsonl':
-                            out.write(json.dumps(result, ensure_ascii=False) + "\n")
-                        else:
-                            json_results.append(result)
-                        duplicates_found += 1
-                        master_files[file_hash] = (fp, mtime)
-                    else:
-                        result = {'newer': fp, 'older': master_path}
-                        if args.format == 'text':
-                            if args.oneline:
-                                print(fp, file=out)
-                            else:
-                                print(f"{fp} ; duplicate of {master_path}", file=out)
-                        elif args.format == 'jsonl':
-                            out.write(json.dumps(result, ensure_ascii=False) + "\n")
-                        else:
-                            json_results.append(result)
-                        duplicates_found += 1
+        scheduler = None
+        if args.workers > 1 or device_workers:
+            scheduler = DeviceScheduler(max(args.workers, 1), args.executor, device_workers)
+        try:
+            if args.write_manifest:
+                with stats.phase('hash'):
+                    entries = build_manifest(files_by_size.records(), args.hash_algo, args.host,
+                                             scheduler=scheduler, max_pending=args.queue_size, cache=cache,
+                                             counters=counters, stats=stats, full_for=full_for,
+                                             drop_cache=not args.keep_page_cache)
+                with stats.phase('manifest'):
+                    write_manifest(args.write_manifest, entries, args.host, args.hash_algo)
+                logging.info(f"Wrote {len(entries)} entries to {args.write_manifest}")
+            else:
+                with stats.phase('hash'):
+                    report_groups(files_by_size.groups(), reporter, stages, scheduler=scheduler,
+                                  max_pending=args.queue_size, cache=cache, counters=counters,
+                                  io_order=args.io_order, stats=stats, reported=reported)
+            if args.watch:
+                out.flush()
+                if cache:
+                    cache.commit()
+                stats.end_progress()
+                with stats.phase('watch'):
+                    watch_tree(roots, files_by_size, inotify, reporter, stages, path_filter, scheduler=scheduler,
+                               cache=cache, counters=counters, follow_symlinks=args.follow_symlinks,
+                               reported=reported)
+        finally:
+            if scheduler:
+                scheduler.shutdown()
     finally:
-        # flush JSON array if needed
-        if args.format == 'json' and out:
+        # close the JSON array if needed
+        if reporter:
             try:
-                out.write(json.dumps(json_results, ensure_ascii=False, indent=2))
-                if out is not sys.stdout:
-                    out.write('\n')
+                reporter.close()
             except Exception as e:
                 print(f"Error writing JSON output: {e}", file=sys.stderr)
+        files_by_size.close()
+        if inotify:
+            inotify.close()
 
         if args.output_file and out and out is not sys.stdout:
             out.close()
 
-        # save cache if requested
-        if cache_enabled and args.cache_file:
+        # flush pending index writes
+        if cache:
+            with stats.phase('cache_save'):
+                try:
+                    cache.close()
+                except sqlite3.Error as e:
+                    print(f"Warning: failed to write cache file {args.cache_file}: {e}", file=sys.stderr)
+                    counters['errors'] += 1
+
+        if not args.watch:
+            stats.end_progress()
+        if args.stats_json:
             try:
-                # prune cache to existing files only
-                pruned = {k: v for k, v in cache.items() if os.path.exists(k)}
-                with open(args.cache_file, 'w', encoding='utf-8') as cf:
-                    json.dump(pruned, cf, ensure_ascii=False)
-            except Exception as e:
-                print(f"Warning: failed to write cache file {args.cache_file}: {e}", file=sys.stderr)
+                if args.stats_json == '-':
+                    json.dump(stats.to_dict(), sys.stderr, indent=2)
+                    sys.stderr.write("\n")
+                else:
+                    with open(args.stats_json, 'w', encoding='utf-8') as sf:
+                        json.dump(stats.to_dict(), sf, indent=2)
+                        sf.write("\n")
+            except OSError as e:
+                print(f"Warning: failed to write stats file {args.stats_json}: {e}", file=sys.stderr)
 
-        # final summary to stderr (always print)
+        # final summary to stderr (hidden by --quiet)
         try:
             logging.info("Summary:")
-            logging.info(f" files scanned: {files_scanned}")
-            logging.info(f" files hashed (this run): {files_hashed}")
-            logging.info(f" cache hits: {cache_hits}")
-            logging.info(f" cache misses: {cache_misses}")
-            logging.info(f" groups inspected: {groups_inspected}")
-            logging.info(f" duplicates found: {duplicates_found}")
-            logging.info(f" skipped files: {skipped_count}")
-            logging.info(f" errors: {errors_count}")
+            logging.info(f" files scanned: {counters['files scanned']}")
+            logging.info(f" files hashed (this run): {counters['files hashed']}")
+            logging.info(f" hash tasks (this run): {counters['hash tasks']}")
+            logging.info(f" cache hits: {counters['cache hits']}")
+            logging.info(f" cache misses: {counters['cache misses']}")
+            logging.info(f" groups inspected: {counters['groups inspected']}")
+            logging.info(f" duplicates found: {counters['duplicates']}")
+            logging.info(f" hardlinks found: {counters['hardlinks']}")
+            logging.info(f" skipped files: {counters['skipped']}")
+            logging.info(f" errors: {counters['errors']}")
         except Exception:
             pass
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -1,22 +1,104 @@
 #!/bin/env python3
 import os
 import re
-from operator import sub
+import time
+import functools
+import datetime
+import json
 import shutil
-from dateutil import parser
 import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+try:
+    from dateutil import parser  # only needed for dates the fast patterns below do not cover
+except ImportError:
+    parser = None
+
+# Possible date.  Either 6 or 8 digits, with possible breaks in between.
+# break could be any non-digit, or non-letter.
+# Should handle 2015.03.19 15.03.19 or 03.19.2015
+DATE_TOKEN = re.compile(r'\d{2,4}[-_. ]?\d{2}[-_. ]?\d{2,4}')
+# The layouts we actually see, parsed without dateutil: three fields split by
+# the same separator, or a bare YYMMDD / YYYYMMDD run of digits.
+SPLIT_DATE = re.compile(r'(\d{2}|\d{4})([-_. ])(\d{2})\2(\d{2}|\d{4})')
+BARE_DATE = re.compile(r'(\d{2}|\d{4})(\d{2})(\d{2})')
 
 def reformat_date(fulldate):
     """
     Reformat a date string to 'yy.mm.dd' format.
     """
     try:
+        if parser is None:
+            raise ValueError("python-dateutil is not installed")
         parsed_date = parser.parse(fulldate, fuzzy=True)
         return parsed_date.strftime("%y.%m.%d")
     except ValueError:
         print(f"Unrecognized date format: {fulldate}")
         return None
 
+def convert_year(year):
+    """
+    Place a two-digit year within 50 years of the current one, like dateutil.
+    """
+    now = time.localtime().tm_year
+    year += now // 100 * 100
+    if year >= now + 50:
+        year -= 100
+    elif year < now - 50:
+        year += 100
+    return year
+
+def fast_date(token):
+    """
+    Parse a date token in one of the common layouts, resolving field order the
+    way dateutil does with yearfirst=True.
+
+    Returns 'yy.mm.dd', False when the token is not a valid date, or None when
+    the layout is not covered and dateutil has to decide.
+    """
+    m = SPLIT_DATE.fullmatch(token)
+    if m:
+        fields = (m.group(1), m.group(3), m.group(4))
+    elif len(token) in (6, 8) and token.isdigit():
+        fields = BARE_DATE.fullmatch(token).groups()
+    else:
+        return None
+    long_fields = [i for i, f in enumerate(fields) if len(f) == 4]
+    if len(long_fields) > 1:
+        return None
+    a, b, c = (int(f) for f in fields)
+    if a > 31 or long_fields == [0] or (b <= 12 and c <= 31):
+        year, month, day = a, b, c
+    elif a > 12:
+        day, month, year = a, b, c
+    else:
+        month, day, year = a, b, c
+    if not long_fields:
+        year = convert_year(year)
+    elif year < 1000:
+        # a short year next to a four digit field; rare enough to leave to dateutil
+        return None
+    try:
+        return datetime.date(year, month, day).strftime("%y.%m.%d")
+    except ValueError:
+        return False
+
+@functools.lru_cache(maxsize=65536)
+def token_date(token):
+    """
+    Return the 'yy.mm.dd' form of a date token, or None.  Memoized, since a
+    directory of photos or scans repeats the same few dates many times.
+    """
+    result = fast_date(token)
+    if result is not None:
+        return result or None
+    if parser is None:
+        return None
+    try:
+        fulldate = parser.parse(token, fuzzy=True, yearfirst=True).strftime("%Y-%m-%d")
+    except (ValueError, OverflowError):
+        return None
+    return reformat_date(fulldate)
+
 def move_file(original_file, new_file, test_mode):
     """
     Move a file to a new location, or simulate the move in test mode.
@@ -33,22 +115,14 @@ def process_file(file):
     """
     Extract a date from the filename, reformat it, and return the new filename.
     """
-    try:
-        # Extract possible date.  Either 6 or 8 digits, with possible breaks in between
-        # break could be any non-digit, or non-letter.
-        # Should handle 2015.03.19 15.03.19 or 03.19.2015
-        possible_date = re.search(r'(\d{2,4}[-_. ]?\d{2}[-_. ]?\d{2,4})', file)
-        if not (possible_date and (-sub(*possible_date.span()) >= 6)):  # If the filename is empty or too short
-            # "No date found in {file}"
-            return None
-        # Extract date from the filename using dateutil.parser
-        fulldate = parser.parse(possible_date.group(0), fuzzy=True, yearfirst=True).strftime("%Y-%m-%d")
-        date = reformat_date(fulldate)
-        if date:
-            return f"{date}_{file}"
-    except ValueError:
-        # No recognizable date found in the filename
+    possible_date = DATE_TOKEN.search(file)
+    if not possible_date:
+        # No date found in {file}
         return None
+    date = token_date(possible_date.group(0))
+    if date:
+        return f"{date}_{file}"
+    return None
 
 def process_directory(target, test_mode):
     """
@@ -61,16 +135,140 @@ def process_directory(target, test_mode):
             if newname:
                 move_file(full_path, os.path.join(target, newname), test_mode)
 
+def plan_directory(path):
+    """
+    List one directory and return (renames, collisions, subdirectories).
+    A rename whose target name already exists is a collision and is not planned.
+    """
+    renames = []
+    collisions = []
+    subdirs = []
+    names = set()
+    candidates = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                names.add(entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif not entry.name[0].isdigit():  # Skip files starting with a number
+                    candidates.append(entry.name)
+    except OSError as e:
+        print(f"Failed to read {path}: {e}")
+        return renames, collisions, subdirs
+    targets = set()
+    for file in candidates:
+        newname = process_file(file)
+        if not newname:
+            continue
+        pair = (os.path.join(path, file), os.path.join(path, newname))
+        if newname in names or newname in targets:
+            collisions.append(pair)
+        else:
+            targets.add(newname)
+            renames.append(pair)
+    return renames, collisions, subdirs
+
+def plan_tree(target, jobs):
+    """
+    Walk `target` recursively, planning each directory on a thread pool.
+    Returns (renames, collisions), both sorted by source path.
+    """
+    renames = []
+    collisions = []
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = {pool.submit(plan_directory, target)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dir_renames, dir_collisions, subdirs = future.result()
+                renames.extend(dir_renames)
+                collisions.extend(dir_collisions)
+                pending.update(pool.submit(plan_directory, d) for d in subdirs)
+    renames.sort()
+    collisions.sort()
+    return renames, collisions
+
+def apply_plan(renames, journal_path):
+    """
+    Rename in place with os.rename (never a copy), writing each step to the
+    journal before doing it so --undo can reverse an interrupted run too.
+    """
+    failed = 0
+    with open(journal_path, 'a', encoding='utf-8') as journal:
+        for original_file, new_file in renames:
+            step = {'from': os.path.abspath(original_file), 'to': os.path.abspath(new_file)}
+            journal.write(json.dumps(step, ensure_ascii=False) + "\n")
+            journal.flush()
+            try:
+                os.rename(original_file, new_file)
+            except OSError as e:
+                print(f"Failed to move {original_file} to {new_file}: {e}")
+                failed += 1
+    return failed
+
+def undo_journal(journal_path, test_mode):
+    """
+    Reverse the renames recorded in a journal, newest first.
+    """
+    try:
+        with open(journal_path, encoding='utf-8') as journal:
+            steps = [json.loads(line) for line in journal if line.strip()]
+        steps = [(step['from'], step['to']) for step in steps]
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"Failed to read journal {journal_path}: {e}")
+        return
+    for original_file, new_file in reversed(steps):
+        if not os.path.lexists(new_file):
+            continue  # never happened, or already undone
+        if os.path.lexists(original_file):
+            print(f"Not restoring {new_file}: {original_file} exists")
+            continue
+        if test_mode:
+            print(f"Would move {new_file} to {original_file}")
+            continue
+        try:
+            os.rename(new_file, original_file)
+        except OSError as e:
+            print(f"Failed to move {new_file} to {original_file}: {e}")
+
+def process_tree(target, test_mode, jobs, journal_path):
+    """
+    Plan every rename below `target` first, then apply the plan.
+    """
+    renames, collisions = plan_tree(target, jobs)
+    for original_file, new_file in collisions:
+        print(f"Skipping {original_file}: {new_file} already exists")
+    if test_mode:
+        for original_file, new_file in renames:
+            print(f"Would move {original_file} to {new_file}")
+        return
+    if not renames:
+        return
+    failed = apply_plan(renames, journal_path)
+    print(f"Renamed {len(renames) - failed} files; undo with: {os.path.basename(__file__)} --undo {journal_path}")
+
 def main():
     parser = argparse.ArgumentParser(description="Fix dates in filenames by moving dates to the beginning.")
     parser.add_argument("target", nargs="?", default=".", help="File or directory to process (default: current directory).")
     parser.add_argument("-t", "--test", action="store_true", help="Test mode: simulate file operations.")
+    parser.add_argument("-r", "--recursive", action="store_true",
+                        help="Process subdirectories too: plan every rename first, skip names that would collide, then rename.")
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="Directories listed in parallel with -r (default: 8).")
+    parser.add_argument("--journal", default=None,
+                        help="Where -r records its renames (default: ~/.fix_dates.<timestamp>.journal).")
+    parser.add_argument("--undo", metavar="JOURNAL", default=None, help="Reverse the renames recorded in JOURNAL.")
     args = parser.parse_args()
 
     target = args.target
     test_mode = args.test
 
-    if os.path.isfile(target):
+    if args.undo:
+        undo_journal(args.undo, test_mode)
+    elif args.recursive and os.path.isdir(target):
+        journal_path = args.journal or os.path.expanduser(f"~/.fix_dates.{time.strftime('%Y%m%d-%H%M%S')}.journal")
+        process_tree(target, test_mode, max(args.jobs, 1), journal_path)
+    elif os.path.isfile(target):
         # If target is a file, process the file
         newname = process_file(os.path.basename(target))
         if newname:
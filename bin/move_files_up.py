@@ -1,4 +1,5 @@
 #!/bin/env python3
+import os
 from pathlib import Path
 import shutil
 import argparse
@@ -49,15 +50,96 @@ def process_directory(directory, test_mode):
                     else:
                         dir_path.rmdir()
 
+def plan_collapse(path, plan, is_root=False):
+    """
+    Bottom-up pass over `path` with one scandir per directory.
+
+    A directory that ends up holding a single file is collapsed into its
+    parent, and so are chains of them: a/b/c/file.mkv becomes a.mkv. Returns
+    the path of the lone file when `path` itself collapses, otherwise None.
+    Renames and emptied directories are appended to `plan` where each chain
+    stops, so every file moves exactly once.
+    """
+    try:
+        entries = list(os.scandir(path))
+    except OSError as e:
+        print(f"Error: Cannot access {path}: {e}. Skipping...")
+        return None
+
+    pending = []  # (subdirectory, lone file inside it)
+    remaining = []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False) and not entry.name.startswith('.'):
+            lone_file = plan_collapse(entry.path, plan)
+            if lone_file:
+                pending.append((entry, lone_file))
+                continue
+        remaining.append(entry)
+
+    if not is_root and len(remaining) + len(pending) == 1:
+        if pending:
+            return pending[0][1]
+        if remaining[0].is_file(follow_symlinks=False):
+            return remaining[0].path
+        return None
+
+    names = {entry.name for entry in entries}
+    for entry, lone_file in pending:
+        new_name = entry.name + os.path.splitext(lone_file)[1]
+        new_path = os.path.join(path, new_name)
+        if new_name in names:
+            print(f"Error: {new_path} already exists. Skipping {lone_file}.")
+            continue
+        names.add(new_name)
+        plan['renames'].append((lone_file, new_path))
+        parent = os.path.dirname(lone_file)
+        while True:
+            plan['rmdirs'].append(parent)
+            if parent == entry.path:
+                break
+            parent = os.path.dirname(parent)
+    return None
+
+def process_tree(directory, test_mode):
+    """
+    Collapse single-file directory chains anywhere below `directory`: plan all
+    renames first, apply them with os.rename, then remove the emptied
+    directories deepest first.
+    """
+    plan = {'renames': [], 'rmdirs': []}
+    plan_collapse(os.fspath(directory), plan, is_root=True)
+    rmdirs = sorted(plan['rmdirs'], key=lambda d: d.count(os.sep), reverse=True)
+    if test_mode:
+        for original_file, new_file in plan['renames']:
+            print(f"Would move {original_file} to {new_file}")
+        for dir_path in rmdirs:
+            print(f"Would remove empty directory: {dir_path}")
+        return
+    for original_file, new_file in plan['renames']:
+        try:
+            os.rename(original_file, new_file)
+        except OSError as e:
+            print(f"Failed to move {original_file} to {new_file}: {e}")
+    for dir_path in rmdirs:
+        try:
+            os.rmdir(dir_path)
+        except OSError:
+            pass  # its file could not be moved, or something else appeared in it
+
 def main():
     parser = argparse.ArgumentParser(description="Move single files from subdirectories up one level, renaming them as 'directory.ext'.")
     parser.add_argument("directory", nargs="?", default=".", help="Directory to process (default: current directory).")
     parser.add_argument("-t", "--test", action="store_true", help="Test mode: simulate file operations.")
+    parser.add_argument("-r", "--recursive", action="store_true",
+                        help="Collapse chains of single-file directories at any depth (a/b/c/file.mkv -> a.mkv).")
 
     args = parser.parse_args()
     test_mode = args.test
 
-    process_directory(args.directory, test_mode)
+    if args.recursive:
+        process_tree(args.directory, test_mode)
+    else:
+        process_directory(args.directory, test_mode)
 
 if __name__ == "__main__":
     main()
@@ -1,12 +1,22 @@
 import imaplib
 import email
+import email.utils
+import heapq
+import json
 import pprint
 import csv
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 import configparser
 
 PRINT = False
 batch_size = 1000
+# Only From and Date are needed; PEEK keeps the messages unread
+HEADER_FIELDS = '(BODY.PEEK[HEADER.FIELDS (FROM DATE)])'
 
 def load_config(config_path='config.ini'):
     config = configparser.ConfigParser()
@@ -15,12 +25,308 @@ def load_config(config_path='config.ini'):
     password = config.get('EMAIL', 'PASSWORD')
     return username, password
 
-def fetch_email_counts(username, password, print_headers=False):
-  from_count = {}
+def load_server(config_path='config.ini'):
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    host = config.get('EMAIL', 'SERVER', fallback='imap.gmail.com')
+    port = config.getint('EMAIL', 'PORT', fallback=993)
+    use_ssl = config.getboolean('EMAIL', 'SSL', fallback=True)
+    return host, port, use_ssl
+
+def load_state_path(config_path='config.ini'):
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    return config.get('EMAIL', 'STATE', fallback='email_counts.sqlite')
+
+def load_report_options(config_path='config.ini'):
+    """
+    TOP limits each report to the K biggest rows (0 for all); FORMAT is csv or
+    json. CAPACITY (0 for none) holds the sender and domain counters to that
+    many keys during a one-pass scan that skips the STATE store.
+    """
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    top = config.getint('EMAIL', 'TOP', fallback=0)
+    fmt = config.get('EMAIL', 'FORMAT', fallback='csv').lower()
+    capacity = config.getint('EMAIL', 'CAPACITY', fallback=0)
+    return top or None, fmt, capacity or None
+
+def load_fetch_options(config_path='config.ini'):
+    """FOLDERS is a comma-separated list of mailboxes, or * for every one; WORKERS is the connection count."""
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    folders = config.get('EMAIL', 'FOLDERS', fallback='INBOX').strip()
+    mailboxes = None if folders == '*' else [f.strip() for f in folders.split(',') if f.strip()]
+    workers = config.getint('EMAIL', 'WORKERS', fallback=1)
+    return mailboxes, workers
+
+def message_set(nums):
+  """Compress message numbers into an IMAP sequence set, e.g. 1:1000,1003"""
+  ranges = []
+  start = prev = None
+  for n in sorted(map(int, nums)):
+    if prev is not None and n == prev + 1:
+      prev = n
+      continue
+    if start is not None:
+      ranges.append(f"{start}:{prev}" if prev > start else str(start))
+    start = prev = n
+  if start is not None:
+    ranges.append(f"{start}:{prev}" if prev > start else str(start))
+  return ','.join(ranges)
+
+UID_ITEM = re.compile(rb'UID (\d+)')
+
+def iter_fetch_headers(data, uid=False):
+  """Yield (message number, header bytes) from the parts of a FETCH response.
+  With uid=True the first value is the message UID instead."""
+  for i, item in enumerate(data):
+    # literals come back as (b'12 (UID 345 BODY[HEADER.FIELDS (FROM)] {45}', b'From: ...'); the rest is b')'
+    if not isinstance(item, tuple):
+      continue
+    if not uid:
+      yield item[0].split(None, 1)[0].decode('ascii'), item[1]
+      continue
+    m = UID_ITEM.search(item[0])
+    if not m and i + 1 < len(data) and isinstance(data[i + 1], bytes):
+      # some servers send the UID after the literal: b' UID 345)'
+      m = UID_ITEM.search(data[i + 1])
+    if m:
+      yield int(m.group(1)), item[1]
+
+_ADDR = rb'[^\s<>()\[\]",;:\\@]+@[^\s<>()\[\]",;:\\@]+'
+PLAIN_ADDR = re.compile(_ADDR)
+# "Display Name <addr>" with nothing parseaddr would treat specially: no
+# quotes, comments, lists, groups or second address outside the brackets
+NAME_ADDR = re.compile(rb'[^<>()\[\]",;:\\@]*<(' + _ADDR + rb')>\s*')
+DATE_DMY = re.compile(rb'(\d{1,2})\s+(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?\s+(\d{2,4})\b', re.I)
+MONTHS = {m: i for i, m in enumerate((b'jan', b'feb', b'mar', b'apr', b'may', b'jun',
+                                      b'jul', b'aug', b'sep', b'oct', b'nov', b'dec'), 1)}
+
+def parse_headers(header):
+  """
+  (sender address, 'YYYY-MM' or '') from a raw header block, straight from
+  the bytes. Only From and Date are unfolded and looked at, and no
+  email.message object is built. Addresses with comments, quoted names or
+  encoded words go through email.utils.parseaddr, so the result matches it.
+  """
+  fields = {}
+  name = None
+  for line in header.split(b'\n'):
+    if line[:1] in (b' ', b'\t'):
+      if name:
+        fields[name] += b' ' + line.strip()
+      continue
+    line = line.rstrip(b'\r')
+    if not line:
+      break
+    key, sep, value = line.partition(b':')
+    name = key.strip().lower() if sep else None
+    if name in (b'from', b'date') and name not in fields:
+      fields[name] = value.strip()
+    else:
+      name = None
+
+  raw_from = fields.get(b'from', b'')
+  m = NAME_ADDR.fullmatch(raw_from) if b'=?' not in raw_from else None
+  if m:
+    sender = m.group(1).decode('utf-8', errors='replace')
+  elif PLAIN_ADDR.fullmatch(raw_from):
+    sender = raw_from.decode('utf-8', errors='replace')
+  else:
+    sender = email.utils.parseaddr(raw_from.decode('utf-8', errors='replace'))[1]
+
+  month = ''
+  raw_date = fields.get(b'date')
+  if raw_date:
+    m = DATE_DMY.search(raw_date)
+    if m:
+      year = int(m.group(3))
+      if year < 100:
+        year += 1900 if year > 68 else 2000
+      month = f"{year:04d}-{MONTHS[m.group(2)[:3].lower()]:02d}"
+    else:
+      parsed = email.utils.parsedate_tz(raw_date.decode('ascii', errors='replace'))
+      if parsed:
+        month = f"{parsed[0]:04d}-{parsed[1]:02d}"
+  return sender, month
+
+def domain_of(sender):
+  """Lowercased part after the last @; a quoted local part may contain more."""
+  return sender.rpartition('@')[2].lower()
+
+def sender_of(header):
+  """The bare address from a From header block."""
+  return parse_headers(header)[0]
+
+class TopCounter:
+  """
+  A counter that can be held to a fixed memory budget. Without a capacity it
+  counts exactly. With one it keeps at most `capacity` keys (the Space-Saving
+  scheme): a new key evicts the current minimum, found through a heap, and
+  inherits its count. Frequent keys stay accurate while millions of one-off
+  senders cannot grow memory.
+  """
+  def __init__(self, capacity=None):
+    self.capacity = capacity
+    self.counts = {}
+    self.heap = []  # (count, key); an entry goes stale when its key is counted again
+
+  def add(self, key, n=1):
+    counts = self.counts
+    if key in counts:
+      counts[key] += n
+      return
+    if self.capacity is None or len(counts) < self.capacity:
+      counts[key] = n
+      if self.capacity is not None:
+        heapq.heappush(self.heap, (n, key))
+      return
+    while True:
+      count, victim = self.heap[0]
+      if counts[victim] == count:
+        break
+      heapq.heapreplace(self.heap, (counts[victim], victim))
+    del counts[victim]
+    counts[key] = count + n
+    heapq.heapreplace(self.heap, (count + n, key))
+
+  def update(self, other):
+    for key, n in other.counts.items():
+      self.add(key, n)
+
+  def top(self, k=None):
+    """(key, count) pairs, biggest first; only the k biggest when k is given."""
+    rows = self.counts.items() if k is None else heapq.nlargest(k, self.counts.items(), key=lambda kv: kv[1])
+    return sorted(rows, key=lambda kv: (-kv[1], kv[0]))
+
+  def __len__(self):
+    return len(self.counts)
+
+class HeaderStats:
+  """Message counts by sender, sender domain and month, each a TopCounter."""
+  KINDS = ('sender', 'domain', 'month')
+
+  def __init__(self, capacity=None):
+    self.sender = TopCounter(capacity)
+    self.domain = TopCounter(capacity)
+    self.month = TopCounter()  # a few hundred months at most
+
+  def add(self, sender, month):
+    self.sender.add(sender)
+    self.domain.add(domain_of(sender))
+    if month:
+      self.month.add(month)
+
+  def update(self, other):
+    for kind in self.KINDS:
+      getattr(self, kind).update(getattr(other, kind))
+
+  def top(self, kind, k=None):
+    if kind == 'month' and k is None:
+      return sorted(self.month.counts.items())
+    return getattr(self, kind).top(k)
+
+def uid_search(M, criteria):
+  typ, data = M.uid('SEARCH', None, criteria)
+  if typ != 'OK':
+    raise imaplib.IMAP4.error(f"UID SEARCH {criteria} failed: {data}")
+  return [int(u) for u in data[0].split()]
+
+class CountStore:
+  """
+  Local SQLite state for incremental runs: per mailbox the UIDVALIDITY and the
+  highest UID seen, the sender of every counted UID, and the per-sender
+  totals, which are updated in place as messages arrive or are expunged.
+  """
+  def __init__(self, path):
+    self.db = sqlite3.connect(path)
+    # the domain report splits senders exactly like HeaderStats
+    self.db.create_function('domain_of', 1, domain_of, deterministic=True)
+    self.db.executescript("""
+      CREATE TABLE IF NOT EXISTS mailboxes (name TEXT PRIMARY KEY, uidvalidity INTEGER, last_uid INTEGER);
+      CREATE TABLE IF NOT EXISTS messages (mailbox TEXT, uid INTEGER, sender TEXT, month TEXT, PRIMARY KEY (mailbox, uid));
+      CREATE TABLE IF NOT EXISTS counts (sender TEXT PRIMARY KEY, count INTEGER NOT NULL);
+    """)
+    columns = [row[1] for row in self.db.execute("PRAGMA table_info(messages)")]
+    if 'month' not in columns:
+      # state from before months were kept; those messages report no month
+      self.db.execute("ALTER TABLE messages ADD COLUMN month TEXT")
+
+  def mailbox(self, name):
+    row = self.db.execute("SELECT uidvalidity, last_uid FROM mailboxes WHERE name = ?", (name,)).fetchone()
+    return row if row else (None, 0)
+
+  def reset(self, name, uidvalidity):
+    """Forget a mailbox whose UIDs were invalidated by the server."""
+    senders = self.db.execute("SELECT sender, COUNT(*) FROM messages WHERE mailbox = ? GROUP BY sender", (name,)).fetchall()
+    self._adjust((sender, -n) for sender, n in senders)
+    self.db.execute("DELETE FROM messages WHERE mailbox = ?", (name,))
+    self.db.execute("INSERT OR REPLACE INTO mailboxes VALUES (?, ?, 0)", (name, uidvalidity))
+    self.db.commit()
+
+  def stored_count(self, name):
+    return self.db.execute("SELECT COUNT(*) FROM messages WHERE mailbox = ?", (name,)).fetchone()[0]
+
+  def stored_uids(self, name):
+    return {uid for (uid,) in self.db.execute("SELECT uid FROM messages WHERE mailbox = ?", (name,))}
+
+  def add(self, name, messages, last_uid):
+    """Record (uid, sender, month) tuples and the new high-water mark in one transaction."""
+    messages = list(messages)
+    self.db.executemany("INSERT OR IGNORE INTO messages (mailbox, uid, sender, month) VALUES (?, ?, ?, ?)",
+                        ((name, uid, sender, month) for uid, sender, month in messages))
+    self._adjust((sender, 1) for _, sender, _ in messages)
+    self.db.execute("UPDATE mailboxes SET last_uid = MAX(last_uid, ?) WHERE name = ?", (last_uid, name))
+    self.db.commit()
+
+  def remove(self, name, uids):
+    """Drop expunged UIDs and take them off their senders' totals."""
+    removed = []
+    for uid in uids:
+      row = self.db.execute("SELECT sender FROM messages WHERE mailbox = ? AND uid = ?", (name, uid)).fetchone()
+      if row:
+        self.db.execute("DELETE FROM messages WHERE mailbox = ? AND uid = ?", (name, uid))
+        removed.append((row[0], -1))
+    self._adjust(removed)
+    self.db.commit()
+    return len(removed)
+
+  def _adjust(self, deltas):
+    self.db.executemany("INSERT INTO counts VALUES (?, ?) ON CONFLICT (sender) DO UPDATE SET count = count + excluded.count",
+                        deltas)
+    self.db.execute("DELETE FROM counts WHERE count <= 0")
+
+  def counts(self):
+    return dict(self.db.execute("SELECT sender, count FROM counts ORDER BY count DESC, sender"))
+
+  REPORTS = {
+    'sender': "SELECT sender, count FROM counts ORDER BY count DESC, sender LIMIT ?",
+    'domain': "SELECT domain_of(sender) AS domain, SUM(count) AS n FROM counts"
+              " GROUP BY domain ORDER BY n DESC, domain LIMIT ?",
+    'month': "SELECT month, COUNT(*) AS n FROM messages WHERE month IS NOT NULL AND month != ''"
+             " GROUP BY month ORDER BY n DESC, month LIMIT ?",
+  }
+
+  def report(self, kind, top=None):
+    """Yield (key, count) rows from a cursor, biggest first; months in date order unless top is given."""
+    query = self.REPORTS[kind]
+    if kind == 'month' and top is None:
+      query = query.replace("ORDER BY n DESC, month", "ORDER BY month")
+    yield from self.db.execute(query, (top if top else -1,))
+
+  def close(self):
+    self.db.close()
+
+def fetch_email_counts(username, password, print_headers=False, host='imap.gmail.com', port=993, use_ssl=True,
+                       capacity=None):
+  """Count the selected mailbox in one pass; returns a HeaderStats."""
+  stats = HeaderStats(capacity)
   try:
-    with imaplib.IMAP4_SSL('imap.gmail.com') as M:
+    connect = imaplib.IMAP4_SSL if use_ssl else imaplib.IMAP4
+    with connect(host, port) as M:
       M.login(username, password)
-      M.select()
+      M.select(readonly=True)
       typ, data = M.search(None, 'ALL')
       message_nums = data[0].split()
       total_message_count = len(message_nums)
@@ -29,20 +335,19 @@ def fetch_email_counts(username, password, print_headers=False):
         batch = message_nums[i:i+batch_size]
         percent = ((i+len(batch))/total_message_count)*100
         print(f"Processing emails {i+1}-{min(i+batch_size, total_message_count)} of {total_message_count} ({percent:.2f}%)", end='\r')
-        for num in batch:
+        # one round trip per batch instead of one per message
+        typ, data = M.fetch(message_set(batch), HEADER_FIELDS)
+        if typ != 'OK':
+          print(f"Error fetching messages {i+1}-{i+len(batch)}: {data}")
+          continue
+        for num, header in iter_fetch_headers(data):
           try:
-            typ, header_data = M.fetch(num, '(BODY.PEEK[HEADER])')
-            headers = header_data[0][1].decode("utf-8", errors="replace")
-            email_message = email.message_from_string(headers)
-            from_nice, from_email = email.utils.parseaddr(email_message['From'])
-            if from_email in from_count:
-              from_count[from_email] += 1
-            else:
-              from_count[from_email] = 1
+            stats.add(*parse_headers(header))
             if print_headers:
+              email_message = email.message_from_bytes(header)
               all_items = email_message.items()
               pp.pprint(all_items)
-              print('Message %s\n%s\n' % (num, header_data[0][1]))
+              print('Message %s\n%s\n' % (num, header))
           except Exception as e:
             print(f"Error processing message {num}: {e}")
       # Print a newline after progress is done
@@ -51,21 +356,286 @@ def fetch_email_counts(username, password, print_headers=False):
       M.logout()
   except Exception as e:
     print(f"IMAP error: {e}")
-  return from_count
+  return stats
 
-def write_counts_to_csv(counts, filename):
+LIST_LINE = re.compile(rb'\((?P<flags>[^)]*)\) (?P<delim>"[^"]*"|NIL) (?P<name>.+)')
+
+def quote_mailbox(name):
+  """Mailbox name as an IMAP astring: quoted unless it is a plain atom."""
+  if name.startswith('"') or re.fullmatch(r'[A-Za-z0-9._/-]+', name):
+    return name
+  return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def list_mailboxes(M):
+  """Names of every selectable mailbox, from LIST."""
+  typ, data = M.list()
+  if typ != 'OK':
+    raise imaplib.IMAP4.error(f"LIST failed: {data}")
+  names = []
+  for line in data:
+    m = LIST_LINE.match(line) if isinstance(line, bytes) else None
+    if not m or b'\\noselect' in m.group('flags').lower():
+      continue
+    name = m.group('name').decode('utf-8', errors='replace')
+    if name.startswith('"') and name.endswith('"'):
+      name = name[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    names.append(name)
+  return names
+
+class IMAPWorkers:
+  """
+  A thread pool where each worker keeps its own IMAP connection, for fetching
+  UID chunks concurrently. A worker whose connection fails reconnects and
+  retries its chunk; the rest of the job carries on.
+  """
+  def __init__(self, username, password, host='imap.gmail.com', port=993, use_ssl=True, workers=4, retries=3):
+    self.login = (username, password)
+    self.address = (host, port)
+    self.connect = imaplib.IMAP4_SSL if use_ssl else imaplib.IMAP4
+    self.retries = retries
+    self.local = threading.local()
+    self.lock = threading.Lock()
+    self.connections = []
+    self.pool = ThreadPoolExecutor(max_workers=workers)
+
+  def _connection(self, mailbox):
+    M = getattr(self.local, 'M', None)
+    if M is None:
+      M = self.connect(*self.address)
+      M.login(*self.login)
+      self.local.M = M
+      self.local.mailbox = None
+      with self.lock:
+        self.connections.append(M)
+    if self.local.mailbox != mailbox:
+      typ, data = M.select(quote_mailbox(mailbox), readonly=True)
+      if typ != 'OK':
+        raise imaplib.IMAP4.error(f"EXAMINE {mailbox} failed: {data}")
+      self.local.mailbox = mailbox
+    return M
+
+  def _drop(self):
+    M = self.local.M
+    self.local.M = None
+    with self.lock:
+      self.connections.remove(M)
+    try:
+      M.shutdown()
+    except Exception:
+      pass
+
+  def fetch_headers(self, mailbox, uids):
+    """[(uid, sender, month)] for one chunk of UIDs."""
+    for attempt in range(self.retries + 1):
+      try:
+        M = self._connection(mailbox)
+        typ, data = M.uid('FETCH', message_set(uids), HEADER_FIELDS)
+        if typ != 'OK':
+          raise imaplib.IMAP4.error(f"UID FETCH in {mailbox} failed: {data}")
+        break
+      except (imaplib.IMAP4.abort, OSError) as e:
+        if getattr(self.local, 'M', None) is not None:
+          self._drop()
+        if attempt == self.retries:
+          raise
+        print(f"Connection lost fetching {mailbox} UIDs {uids[0]}-{uids[-1]} ({e}); reconnecting")
+        time.sleep(min(2 ** attempt, 30))
+    rows = []
+    for uid, header in iter_fetch_headers(data, uid=True):
+      try:
+        rows.append((uid, *parse_headers(header)))
+      except Exception as e:
+        print(f"Error processing UID {uid} in {mailbox}: {e}")
+    return rows
+
+  def submit(self, mailbox, uids):
+    return self.pool.submit(self.fetch_headers, mailbox, uids)
+
+  def close(self):
+    self.pool.shutdown(wait=True, cancel_futures=True)
+    for M in self.connections:
+      try:
+        M.logout()
+      except Exception:
+        pass
+    self.connections = []
+
+def fetch_email_counts_parallel(username, password, host='imap.gmail.com', port=993, use_ssl=True, workers=4,
+                                mailboxes=('INBOX',), capacity=None):
+  """
+  Count `mailboxes` (None for every mailbox LIST returns) with `workers`
+  connections and return a HeaderStats. The UID list of each mailbox is cut
+  into chunks of batch_size and spread over the pool. Each chunk is tallied
+  on its own and merged into the total as it completes. A chunk that has to
+  be retried after a reconnect is never counted twice.
+  """
+  stats = HeaderStats(capacity)
+  connect = imaplib.IMAP4_SSL if use_ssl else imaplib.IMAP4
+  pool = IMAPWorkers(username, password, host, port, use_ssl, workers)
+  try:
+    with connect(host, port) as M:
+      M.login(username, password)
+      if mailboxes is None:
+        mailboxes = list_mailboxes(M)
+      futures = []
+      for mailbox in mailboxes:
+        typ, data = M.select(quote_mailbox(mailbox), readonly=True)
+        if typ != 'OK':
+          print(f"Skipping {mailbox}: {data}")
+          continue
+        uids = uid_search(M, 'ALL')
+        futures.extend(pool.submit(mailbox, uids[i:i+batch_size]) for i in range(0, len(uids), batch_size))
+      M.logout()
+    done = 0
+    for future in as_completed(futures):
+      done += 1
+      print(f"Fetched {done} of {len(futures)} batches ({done / len(futures) * 100:.2f}%)", end='\r')
+      try:
+        chunk = HeaderStats()
+        for _, sender, month in future.result():
+          chunk.add(sender, month)
+        stats.update(chunk)
+      except Exception as e:
+        print(f"Error fetching a batch: {e}")
+    if futures:
+      print()
+  except Exception as e:
+    print(f"IMAP error: {e}")
+  finally:
+    pool.close()
+  return stats
+
+def sync_mailbox(M, store, mailbox, pool=None, print_headers=False):
+  """
+  Bring `store` up to date with one mailbox on connection `M`. Only UIDs above
+  the stored high-water mark are fetched. Expunged messages are reconciled
+  when the message count shows that some are missing. With a `pool` the
+  chunks are fetched concurrently, but results are stored in UID order, so
+  the high-water mark never skips a chunk.
+  """
+  # EXAMINE: still gives EXISTS and UIDVALIDITY, and CLOSE then expunges nothing
+  typ, data = M.select(quote_mailbox(mailbox), readonly=True)
+  if typ != 'OK':
+    raise imaplib.IMAP4.error(f"EXAMINE {mailbox} failed: {data}")
+  exists = int(data[0])
+  uidvalidity = int(M.response('UIDVALIDITY')[1][0])
+  known_validity, last_uid = store.mailbox(mailbox)
+  if known_validity != uidvalidity:
+    if known_validity is not None:
+      print(f"UIDVALIDITY of {mailbox} changed; recounting it")
+    store.reset(mailbox, uidvalidity)
+    last_uid = 0
+
+  # 'n:*' always matches the highest UID, even when it is below n
+  new_uids = [u for u in uid_search(M, f'UID {last_uid + 1}:*') if u > last_uid]
+  stored = store.stored_count(mailbox)
+  if stored + len(new_uids) != exists:
+    current = set(uid_search(M, f'UID 1:{last_uid}')) if last_uid else set()
+    gone = store.stored_uids(mailbox) - current
+    print(f"Removed {store.remove(mailbox, gone)} expunged messages from {mailbox}")
+
+  pp = pprint.PrettyPrinter(indent=4)
+  total = len(new_uids)
+  batches = [new_uids[i:i+batch_size] for i in range(0, total, batch_size)]
+  futures = [pool.submit(mailbox, batch) for batch in batches] if pool else None
+  for n, batch in enumerate(batches):
+    percent = ((n * batch_size + len(batch))/total)*100
+    print(f"Fetching new emails in {mailbox} {n*batch_size+1}-{n*batch_size+len(batch)} of {total} ({percent:.2f}%)", end='\r')
+    if futures:
+      try:
+        senders = futures[n].result()
+      except Exception as e:
+        print(f"Error fetching UIDs {batch[0]}-{batch[-1]}: {e}")
+        break  # keep the high-water mark below this batch so the next run retries it
+    else:
+      typ, data = M.uid('FETCH', message_set(batch), HEADER_FIELDS)
+      if typ != 'OK':
+        print(f"Error fetching UIDs {batch[0]}-{batch[-1]}: {data}")
+        break
+      senders = []
+      for uid, header in iter_fetch_headers(data, uid=True):
+        try:
+          senders.append((uid, *parse_headers(header)))
+          if print_headers:
+            pp.pprint(email.message_from_bytes(header).items())
+        except Exception as e:
+          print(f"Error processing UID {uid}: {e}")
+    store.add(mailbox, senders, batch[-1])
+  if total:
+    print()
+  M.close()
+
+def sync_email_counts(username, password, store, print_headers=False, host='imap.gmail.com', port=993, use_ssl=True,
+                      mailboxes=('INBOX',), workers=1):
+  """
+  Bring `store` up to date with `mailboxes` (None for every mailbox LIST
+  returns). Read the results back with store.counts() or store.report().
+  """
+  pool = None
+  try:
+    connect = imaplib.IMAP4_SSL if use_ssl else imaplib.IMAP4
+    with connect(host, port) as M:
+      M.login(username, password)
+      if mailboxes is None:
+        mailboxes = list_mailboxes(M)
+      if workers > 1:
+        pool = IMAPWorkers(username, password, host, port, use_ssl, workers)
+      for mailbox in mailboxes:
+        sync_mailbox(M, store, mailbox, pool, print_headers)
+      M.logout()
+  except Exception as e:
+    print(f"IMAP error: {e}")
+  finally:
+    if pool:
+      pool.close()
+
+def write_report(rows, filename, label, fmt='csv'):
+  """Write (key, count) rows as they arrive: CSV with a header row, or a JSON array of objects."""
   try:
     with open(filename, 'w', newline='', encoding='utf-8') as f:
-      writer = csv.writer(f)
-      writer.writerow(['Email', 'Count'])
-      for email_addr, count in counts.items():
-        writer.writerow([email_addr, count])
+      if fmt == 'json':
+        sep = '[\n  '
+        for key, count in rows:
+          f.write(sep + json.dumps({label.lower(): key, 'count': count}, ensure_ascii=False))
+          sep = ',\n  '
+        f.write('[]\n' if sep.startswith('[') else '\n]\n')
+      else:
+        writer = csv.writer(f)
+        writer.writerow([label, 'Count'])
+        writer.writerows(rows)
   except Exception as e:
-    print(f"Error writing CSV: {e}")
+    print(f"Error writing {filename}: {e}")
+
+def write_counts_to_csv(counts, filename):
+  write_report(counts.items(), filename, 'Email')
+
+# report kind -> (file name prefix, column label)
+REPORTS = {
+  'sender': ('email_counts', 'Email'),
+  'domain': ('email_domains', 'Domain'),
+  'month': ('email_months', 'Month'),
+}
 
 if __name__ == "__main__":
   USERNAME, PASSWORD = load_config()
-  counts = fetch_email_counts(USERNAME, PASSWORD, PRINT)
-  timestamp = datetime.now().strftime('%Y%m%d%H%M')
-  output_filename = f'email_counts.{timestamp}.csv'
-  write_counts_to_csv(counts, output_filename)
\ No newline at end of file
+  HOST, PORT, USE_SSL = load_server()
+  MAILBOXES, WORKERS = load_fetch_options()
+  TOP, FORMAT, CAPACITY = load_report_options()
+  store = None
+  try:
+    if CAPACITY:
+      # bounded memory, approximate counts past CAPACITY keys, nothing kept between runs
+      stats = fetch_email_counts_parallel(USERNAME, PASSWORD, host=HOST, port=PORT, use_ssl=USE_SSL,
+                                          workers=max(WORKERS, 1), mailboxes=MAILBOXES, capacity=CAPACITY)
+      report = stats.top
+    else:
+      store = CountStore(load_state_path())
+      sync_email_counts(USERNAME, PASSWORD, store, PRINT, host=HOST, port=PORT, use_ssl=USE_SSL,
+                        mailboxes=MAILBOXES, workers=WORKERS)
+      report = store.report
+    timestamp = datetime.now().strftime('%Y%m%d%H%M')
+    for kind, (prefix, label) in REPORTS.items():
+      write_report(report(kind, TOP), f'{prefix}.{timestamp}.{FORMAT}', label, FORMAT)
+  finally:
+    if store:
+      store.close()
\ No newline at end of file